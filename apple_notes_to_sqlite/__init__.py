@@ -0,0 +1,3 @@
+from .index import NotesIndex
+
+__all__ = ["NotesIndex"]
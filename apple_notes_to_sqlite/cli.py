@@ -1,13 +1,31 @@
+import array
 import click
+import concurrent.futures
+import contextlib
+import datetime
+import fnmatch
+import gzip
+import hashlib
+import html
 import json
 import os
+import random
 import re
 import secrets
 import sqlite3
 import sqlite_utils
+import statistics
 import subprocess
+import sys
+import tempfile
+import time
 from pathlib import Path
 
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
 COUNT_SCRIPT = """
 tell application "Notes"
     set noteCount to count of notes
@@ -136,13 +154,129 @@ tell application "Notes"
    end repeat
 end tell
 """.strip()
+
+NOTES_BY_ID_SCRIPT = """
+tell application "Notes"
+   set noteIds to {{{note_ids}}}
+   repeat with targetId in noteIds
+      -- A note deleted since it was listed must not end the whole batch
+      try
+         set eachNote to note id targetId
+         set noteId to the id of eachNote
+         set noteTitle to the name of eachNote
+         set noteBody to the body of eachNote
+         set noteCreatedDate to the creation date of eachNote
+         set noteCreated to (noteCreatedDate as «class isot» as string)
+         set noteUpdatedDate to the modification date of eachNote
+         set noteUpdated to (noteUpdatedDate as «class isot» as string)
+         set noteContainer to container of eachNote
+         set noteFolderId to the id of noteContainer
+         log "{split}-id: " & noteId & "\n"
+         log "{split}-created: " & noteCreated & "\n"
+         log "{split}-updated: " & noteUpdated & "\n"
+         log "{split}-folder: " & noteFolderId & "\n"
+         log "{split}-title: " & noteTitle & "\n\n"
+         log noteBody & "\n"
+         log "{split}{split}" & "\n"
+      end try
+   end repeat
+end tell
+""".strip()
+
+# Note properties without the body, which is by far the slowest to fetch
+METADATA_SCRIPT = """
+tell application "Notes"
+   repeat with eachNote in every note
+      set noteId to the id of eachNote
+      set noteTitle to the name of eachNote
+      set noteCreatedDate to the creation date of eachNote
+      set noteCreated to (noteCreatedDate as «class isot» as string)
+      set noteUpdatedDate to the modification date of eachNote
+      set noteUpdated to (noteUpdatedDate as «class isot» as string)
+      set noteContainer to container of eachNote
+      set noteFolderId to the id of noteContainer
+      log "{split}-id: " & noteId & "\n"
+      log "{split}-created: " & noteCreated & "\n"
+      log "{split}-updated: " & noteUpdated & "\n"
+      log "{split}-folder: " & noteFolderId & "\n"
+      log "{split}-title: " & noteTitle & "\n"
+      log "{split}{split}" & "\n"
+   end repeat
+end tell
+""".strip()
+
+# Number of notes fetched per osascript invocation by extract_notes_by_ids()
+NOTE_ID_BATCH_SIZE = 100
+
+# Core Data stores dates as seconds since 2001-01-01T00:00:00Z
+COREDATA_EPOCH_OFFSET = 978307200
+
+HTML_TAG_RE = re.compile(r"<[^>]+>")
+# A # not preceded by a word character, &, # or / (so no URL fragments or
+# character references), followed by a word that is not just digits
+HASHTAG_RE = re.compile(r"(?<![\w&#/])#(?!\d+(?![\w-]))(\w[\w-]*)")
+
+# MinHash/LSH settings for near-duplicate detection. 128 permutations in
+# 32 bands of 4 rows makes notes that are ~42% similar likely to share a
+# bucket; candidates are then checked against the requested threshold.
+MINHASH_PRIME = (1 << 61) - 1
+# Fixed seed: signatures stored in a database must stay comparable
+_minhash_random = random.Random(1729)
+MINHASH_PERMUTATIONS = [
+    (_minhash_random.randrange(1, MINHASH_PRIME), _minhash_random.randrange(MINHASH_PRIME))
+    for _ in range(128)
+]
+MINHASH_BANDS = 32
+MINHASH_SHINGLE_SIZE = 3
+DEFAULT_DUPLICATE_THRESHOLD = 0.8
+
+# Length of the note ID hash prefix used to bucket notes in --verify trees
+MERKLE_BUCKET_PREFIX = 2
+
+# Upper bound on memory-mapped I/O for the NoteStore snapshot
+NOTESTORE_MMAP_SIZE = 256 * 1024 * 1024
+
+# Runs slower than this multiple of the median of recent runs are flagged
+DEFAULT_SLOW_FACTOR = 1.5
+DEFAULT_HISTORY_WINDOW = 10
+
+# Fields that --fields can select for --dump
+NOTE_FIELDS = ("id", "title", "folder", "created", "updated", "body")
+
+RECORDING_HEADER = "apple-notes-to-sqlite-recording"
+RECORDING_VERSION = "1"
+
 DEFAULT_NOTESTORE_PATH = Path(
     "~/Library/Group Containers/group.com.apple.notes/NoteStore.sqlite"
 ).expanduser()
 
 
-@click.command()
+class DefaultGroup(click.Group):
+    "Group that runs its default command when no command name is given"
+
+    def __init__(self, *args, default_command=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default_command = default_command
+
+    def parse_args(self, ctx, args):
+        if not args or (
+            args[0] not in self.commands and args[0] not in ("--help", "--version")
+        ):
+            args.insert(0, self.default_command)
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=DefaultGroup, default_command="export")
 @click.version_option()
+def cli():
+    """
+    Export Apple Notes to SQLite
+
+    Running without a command runs 'export'.
+    """
+
+
+@cli.command()
 @click.argument(
     "db_path",
     type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
@@ -171,10 +305,72 @@ DEFAULT_NOTESTORE_PATH = Path(
 )
 @click.option(
     "--folder",
-    "folder_filter",
-    help="Only export notes from this folder (by path, name, or long_id)",
+    "folder_filters",
+    multiple=True,
+    help=(
+        "Only export notes from this folder (by path, name, long_id or glob "
+        "pattern such as 'Work/*'). Can be used multiple times"
+    ),
+)
+@click.option(
+    "--record",
+    type=click.Path(file_okay=True, dir_okay=False, writable=True),
+    help="Save the raw output extracted from Notes to this compressed file",
+)
+@click.option(
+    "--replay",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    help="Read folders and notes from a --record file instead of Notes",
+)
+@click.option(
+    "--minhash",
+    is_flag=True,
+    help=(
+        "Maintain MinHash signatures for changed notes, used by the "
+        "duplicates command. Stays enabled for later runs"
+    ),
+)
+@click.option(
+    "--changes",
+    "track_changes",
+    is_flag=True,
+    help=(
+        "Record inserts, updates and deletes of notes and folders in a "
+        "changes table. Stays enabled for later runs"
+    ),
+)
+@click.option(
+    "--verify",
+    is_flag=True,
+    help=(
+        "Compare note IDs and modification dates in Notes with the database "
+        "and repair only the notes that differ"
+    ),
+)
+@click.option(
+    "--metadata-first",
+    is_flag=True,
+    help=(
+        "Write the title, dates and folder of every changed note first, then "
+        "fetch bodies, most recently modified first"
+    ),
+)
+@click.option(
+    "--max-duration",
+    type=click.FloatRange(min=0, min_open=True),
+    help=(
+        "Stop fetching notes after this many seconds, most recently modified "
+        "first. The next run continues with the older notes"
+    ),
+)
+@click.option(
+    "--fields",
+    help=(
+        "Comma-separated fields to output with --dump, e.g. id,title,updated. "
+        "Bodies are not fetched unless body is included"
+    ),
 )
-def cli(
+def export(
     db_path,
     stop_after,
     dump,
@@ -182,7 +378,15 @@ def cli(
     sync,
     sync_delete_missing,
     full,
-    folder_filter,
+    folder_filters,
+    record,
+    replay,
+    minhash,
+    track_changes,
+    verify,
+    metadata_first,
+    max_duration,
+    fields,
 ):
     """
     Export Apple Notes to SQLite
@@ -200,48 +404,79 @@ def cli(
         )
     if sync_delete_missing and stop_after:
         raise click.UsageError("--sync-delete-missing cannot be used with --stop-after")
+    if record and replay:
+        raise click.UsageError("--record and --replay cannot be used together")
+    if verify and (dump or replay or stop_after):
+        raise click.UsageError(
+            "--verify cannot be used with --dump, --replay or --stop-after"
+        )
+    if metadata_first and (dump or replay or verify or stop_after):
+        raise click.UsageError(
+            "--metadata-first cannot be used with --dump, --replay, --verify "
+            "or --stop-after"
+        )
+    if max_duration and (
+        dump or verify or full or sync_delete_missing or metadata_first or stop_after
+    ):
+        raise click.UsageError(
+            "--max-duration cannot be used with --dump, --verify, --full, "
+            "--sync-delete-missing, --metadata-first or --stop-after"
+        )
+    if fields is not None:
+        if not dump:
+            raise click.UsageError("--fields can only be used with --dump")
+        fields = [field.strip() for field in fields.split(",") if field.strip()]
+        unknown = [field for field in fields if field not in NOTE_FIELDS]
+        if unknown or not fields:
+            raise click.UsageError(
+                "--fields must be a comma-separated list of: {}".format(
+                    ", ".join(NOTE_FIELDS)
+                )
+            )
     incremental_sync = sync and not full
+    recorder = None
+    if record:
+        recorder = Recorder(record)
+        click.get_current_context().call_on_close(recorder.close)
+    notestore = None if replay else open_notestore()
+    if notestore is not None:
+        click.get_current_context().call_on_close(notestore.close)
     # Use click progressbar
     i = 0
     allowed_note_long_ids = None
     allowed_folder_long_ids = None
     allowed_folder_pks = None
-    folder_filter_long_id = None
-    folder_long_ids_to_pk = {}
     if dump:
-        if folder_filter:
+        if folder_filters:
             click.echo("Fetching folders from Notes…", err=True)
-            folders = extract_folders()
+            if replay:
+                tree = FolderTree(replay_folders(replay))
+            else:
+                tree = FolderTree(extract_folders(recorder=recorder, notestore=notestore))
             (
-                folder_filter_long_id,
                 allowed_note_long_ids,
                 allowed_folder_long_ids,
-            ) = resolve_folder_filter(folder_filter, folders)
-            folder_long_ids_to_pk = {
-                folder.get("long_id"): folder.get("pk")
-                for folder in folders
-                if folder.get("pk") is not None
-            }
-            if folder_long_ids_to_pk:
-                allowed_folder_pks = [
-                    folder_long_ids_to_pk.get(folder_id)
-                    for folder_id in allowed_note_long_ids
-                    if folder_long_ids_to_pk.get(folder_id) is not None
-                ]
+            ) = resolve_folder_filters(folder_filters, tree)
+            allowed_folder_pks = folder_pks_for(tree, allowed_note_long_ids)
         click.echo("Fetching notes from Notes…", err=True)
-        if allowed_folder_pks:
-            folder_coredata_ids = [
-                f"{get_coredata_base()}/ICFolder/p{pk}" for pk in allowed_folder_pks
-            ]
-            notes_iter = extract_notes_for_folders(folder_coredata_ids)
+        if replay:
+            notes_iter = replay_notes(replay)
+        elif fields is not None and "body" not in fields:
+            notes_iter = extract_note_metadata(recorder=recorder)
+        elif allowed_folder_pks:
+            notes_iter = extract_notes_for_folders(
+                folder_coredata_ids_for(tree, allowed_folder_pks), recorder=recorder
+            )
         else:
-            notes_iter = extract_notes()
+            notes_iter = extract_notes(recorder=recorder)
         for note in notes_iter:
             if (
                 allowed_note_long_ids is not None
                 and note.get("folder") not in allowed_note_long_ids
             ):
                 continue
+            if fields is not None:
+                note = {field: note.get(field) for field in fields}
             click.echo(json.dumps(note))
             i += 1
             if stop_after and i >= stop_after:
@@ -252,38 +487,18 @@ def cli(
         seen_note_ids = set() if sync_delete_missing else None
         latest_updated = None
         last_sync = None
-        # Create schema
-        folder_long_ids_to_id = {}
-        if not db["folders"].exists():
-            db["folders"].create(
-                {
-                    "id": int,
-                    "long_id": str,
-                    "name": str,
-                    "parent": int,
-                },
-                pk="id",
-            )
-            db["folders"].create_index(["long_id"], unique=True)
-            db["folders"].add_foreign_key("parent", "folders", "id")
-        if not db["notes"].exists():
-            db["notes"].create(
-                {
-                    "id": str,
-                    "created": str,
-                    "updated": str,
-                    "folder": int,
-                    "title": str,
-                    "body": str,
-                },
-                pk="id",
-            )
-            db["notes"].add_foreign_key("folder", "folders", "id")
-        if not db["sync_state"].exists():
-            db["sync_state"].create({"key": str, "value": str}, pk="key")
+        ensure_schema(db)
+        if minhash:
+            ensure_minhash_tables(db)
+        if track_changes:
+            ensure_changes_table(db)
         if schema:
             # Our work is done
             return
+        run = SyncRun()
+        click.get_current_context().call_on_close(lambda: run.finish(db))
+        # Once enabled, signatures are kept up to date on every run
+        minhash = db["note_minhashes"].exists()
         if incremental_sync:
             try:
                 row = db["sync_state"].get("last_sync")
@@ -301,142 +516,253 @@ def cli(
             last_sync = None
         if full:
             existing_updates = None
+        if verify:
+            run.mode = "verify"
+        elif metadata_first:
+            run.mode = "metadata-first"
+        elif max_duration:
+            run.mode = "budgeted"
+        elif sync_delete_missing:
+            run.mode = "delete-missing"
+        elif folder_filters:
+            run.mode = "folder-scoped"
+        else:
+            run.mode = "incremental" if last_sync else "full"
 
         click.echo("Fetching folders from Notes…", err=True)
-        folders = extract_folders()
-        if folder_filter:
-            (
-                folder_filter_long_id,
-                allowed_note_long_ids,
-                allowed_folder_long_ids,
-            ) = resolve_folder_filter(folder_filter, folders)
-            folder_long_ids_to_pk = {
-                folder.get("long_id"): folder.get("pk")
-                for folder in folders
-                if folder.get("pk") is not None
-            }
-            if folder_long_ids_to_pk:
-                allowed_folder_pks = [
-                    folder_long_ids_to_pk.get(folder_id)
-                    for folder_id in allowed_note_long_ids
-                    if folder_long_ids_to_pk.get(folder_id) is not None
-                ]
-            folders = [
-                folder
-                for folder in folders
-                if folder.get("long_id") in allowed_folder_long_ids
-            ]
-        for folder in topological_sort(folders):
-            if (
-                allowed_folder_long_ids is not None
-                and folder.get("parent") not in allowed_folder_long_ids
-            ):
-                folder["parent"] = None
-            folder["parent"] = folder_long_ids_to_id.get(folder["parent"])
-            folder_db = {k: v for k, v in folder.items() if k != "pk"}
-            id = db["folders"].insert(folder_db, pk="id", replace=True).last_pk
-            folder_long_ids_to_id[folder["long_id"]] = id
-
-        expected_count = stop_after
-        if not expected_count and allowed_folder_pks:
-            expected_count = count_notes_for_folders(allowed_folder_pks)
-        if not expected_count and not folder_filter_long_id:
-            click.echo("Counting notes…", err=True)
-            expected_count = count_notes()
-
-        click.echo("Exporting notes…", err=True)
-        if expected_count:
-            with click.progressbar(
-                length=expected_count,
-                label="Exporting notes",
-                show_eta=True,
-                show_pos=True,
-            ) as bar:
-                if allowed_folder_pks:
-                    folder_coredata_ids = [
-                        f"{get_coredata_base()}/ICFolder/p{pk}"
-                        for pk in allowed_folder_pks
-                    ]
-                    notes_iter = extract_notes_for_folders(
-                        folder_coredata_ids, since=last_sync
-                    )
-                else:
-                    notes_iter = extract_notes(since=last_sync)
-                for note in notes_iter:
-                    if (
-                        allowed_note_long_ids is not None
-                        and note.get("folder") not in allowed_note_long_ids
-                    ):
-                        continue
-                    if seen_note_ids is not None:
-                        seen_note_ids.add(note["id"])
-                    if existing_updates is not None:
-                        if existing_updates.get(note["id"]) == note.get("updated"):
-                            bar.update(1)
-                            i += 1
-                            if stop_after and i >= stop_after:
-                                break
-                            continue
-                    if latest_updated is None or note.get("updated") > latest_updated:
-                        latest_updated = note.get("updated")
-                    # Fix the folder
-                    note["folder"] = folder_long_ids_to_id.get(note["folder"])
-                    db["notes"].insert(
-                        note,
-                        replace=True,
-                        alter=True,
-                    )
-                    bar.update(1)
-                    i += 1
-                    if stop_after and i >= stop_after:
-                        break
+        with run.phase("folders"):
+            if replay:
+                folders = replay_folders(replay)
+            else:
+                folders = extract_folders(recorder=recorder, notestore=notestore)
+            tree = FolderTree(folders)
+            if folder_filters:
+                (
+                    allowed_note_long_ids,
+                    allowed_folder_long_ids,
+                ) = resolve_folder_filters(folder_filters, tree)
+                allowed_folder_pks = folder_pks_for(tree, allowed_note_long_ids)
+            folder_long_ids_to_id = write_folders(
+                db, tree, allowed_folder_long_ids=allowed_folder_long_ids
+            )
+
+        if verify:
+            click.echo("Verifying notes…", err=True)
+            with run.phase("verify"):
+                result = verify_notes(
+                    db,
+                    folder_long_ids_to_id,
+                    note_folder_long_ids=allowed_note_long_ids,
+                    recorder=recorder,
+                    minhash=minhash,
+                    notestore=notestore,
+                )
+            click.echo(
+                "Checked {checked} notes: {changed} changed, {missing} missing, "
+                "{extra} deleted from Notes".format(**result),
+                err=True,
+            )
+            run.notes_seen = result["checked"]
+            run.notes_written = result["changed"] + result["missing"]
+            run.notes_deleted = result["extra"]
+            run.status = "completed"
+            return
+
+        if metadata_first:
+            click.echo("Fetching note metadata from Notes…", err=True)
+            with run.phase("metadata"):
+                latest_updated = sync_note_metadata(
+                    db,
+                    folder_long_ids_to_id,
+                    existing_updates=existing_updates,
+                    note_folder_long_ids=allowed_note_long_ids,
+                    seen_note_ids=seen_note_ids,
+                    recorder=recorder,
+                    run=run,
+                )
+        elif max_duration:
+            try:
+                resume = json.loads(db["sync_state"].get("resume")["value"])
+            except sqlite_utils.db.NotFoundError:
+                resume = None
+            if resume and resume.get("remaining"):
+                click.echo(
+                    "Continuing with {remaining} notes modified at or before "
+                    "{next_updated}…".format(**resume),
+                    err=True,
+                )
+            if resume and resume.get("pending_bodies"):
+                click.echo(
+                    "Continuing with {pending_bodies} pending note bodies…".format(
+                        **resume
+                    ),
+                    err=True,
+                )
+            click.echo("Exporting notes, most recently modified first…", err=True)
+            with run.phase("notes"):
+                latest_updated, remaining = sync_notes_within_budget(
+                    db,
+                    folder_long_ids_to_id,
+                    deadline=run.clock + max_duration,
+                    existing_updates=existing_updates,
+                    note_folder_long_ids=allowed_note_long_ids,
+                    notestore=notestore,
+                    recorder=recorder,
+                    replay=replay,
+                    minhash=minhash,
+                    run=run,
+                )
+            if remaining:
+                # Keep last_sync where it was, so the next run still sees
+                # the older notes that were not reached
+                save_resume(
+                    db,
+                    {
+                        "remaining": len(remaining),
+                        "next_id": remaining[0]["id"],
+                        "next_updated": remaining[0]["updated"],
+                    },
+                )
+                click.echo(
+                    f"Time budget used up, {len(remaining)} notes left for the next run",
+                    err=True,
+                )
+                run.status = "partial"
+                return
+            with db.conn:
+                db.execute("delete from sync_state where key = 'resume'")
         else:
-            if allowed_folder_pks:
-                folder_coredata_ids = [
-                    f"{get_coredata_base()}/ICFolder/p{pk}"
-                    for pk in allowed_folder_pks
+            with run.phase("count"):
+                changed_note_ids = None
+                if last_sync and notestore is not None:
+                    # Ask NoteStore which notes changed, then fetch only those
+                    changed_note_ids = changed_note_ids_from_notestore(
+                        notestore, last_sync, folder_pks=allowed_folder_pks
+                    )
+                expected_count = stop_after
+                if not expected_count and changed_note_ids is not None:
+                    expected_count = len(changed_note_ids)
+                if not expected_count and allowed_folder_pks and not replay:
+                    expected_count = count_notes_for_folders(allowed_folder_pks, notestore)
+                if (
+                    not expected_count
+                    and not folder_filters
+                    and changed_note_ids is None
+                    and not replay
+                ):
+                    click.echo("Counting notes…", err=True)
+                    expected_count = count_notes()
+
+            # Changed notes that must come back before last_sync can move on
+            unreturned_note_ids = set()
+            if replay:
+                notes_iter = replay_notes(replay)
+            elif changed_note_ids is not None:
+                requested_note_ids = [
+                    f"{notestore.coredata_base}/ICNote/p{pk}" for pk in changed_note_ids
                 ]
+                unreturned_note_ids.update(requested_note_ids)
+                notes_iter = extract_notes_by_ids(requested_note_ids, recorder=recorder)
+            elif allowed_folder_pks:
                 notes_iter = extract_notes_for_folders(
-                    folder_coredata_ids, since=last_sync
+                    folder_coredata_ids_for(tree, allowed_folder_pks),
+                    since=last_sync,
+                    recorder=recorder,
                 )
             else:
-                notes_iter = extract_notes(since=last_sync)
-            with click.progressbar(
-                notes_iter,
-                label="Exporting notes",
-                show_eta=False,
-                show_pos=True,
-            ) as bar:
-                for note in bar:
-                    if (
-                        allowed_note_long_ids is not None
-                        and note.get("folder") not in allowed_note_long_ids
-                    ):
-                        continue
-                    if seen_note_ids is not None:
-                        seen_note_ids.add(note["id"])
-                    if existing_updates is not None:
-                        if existing_updates.get(note["id"]) == note.get("updated"):
-                            i += 1
-                            if stop_after and i >= stop_after:
-                                break
+                notes_iter = extract_notes(since=last_sync, recorder=recorder)
+
+            click.echo("Exporting notes…", err=True)
+            notes_started = time.perf_counter()
+            if expected_count:
+                with click.progressbar(
+                    length=expected_count,
+                    label="Exporting notes",
+                    show_eta=True,
+                    show_pos=True,
+                ) as bar:
+                    for note in notes_iter:
+                        unreturned_note_ids.discard(note["id"])
+                        if (
+                            allowed_note_long_ids is not None
+                            and note.get("folder") not in allowed_note_long_ids
+                        ):
                             continue
-                    if latest_updated is None or note.get("updated") > latest_updated:
-                        latest_updated = note.get("updated")
-                    # Fix the folder
-                    note["folder"] = folder_long_ids_to_id.get(note["folder"])
-                    db["notes"].insert(
-                        note,
-                        replace=True,
-                        alter=True,
-                    )
-                    i += 1
-                    if stop_after and i >= stop_after:
-                        break
+                        run.saw(note)
+                        if seen_note_ids is not None:
+                            seen_note_ids.add(note["id"])
+                        if existing_updates is not None:
+                            if existing_updates.get(note["id"]) == note.get("updated"):
+                                run.notes_skipped += 1
+                                bar.update(1)
+                                i += 1
+                                if stop_after and i >= stop_after:
+                                    break
+                                continue
+                        if latest_updated is None or note.get("updated") > latest_updated:
+                            latest_updated = note.get("updated")
+                        # Fix the folder
+                        note["folder"] = folder_long_ids_to_id.get(note["folder"])
+                        with run.phase("write"):
+                            write_note(db, note, minhash=minhash)
+                        run.notes_written += 1
+                        bar.update(1)
+                        i += 1
+                        if stop_after and i >= stop_after:
+                            break
+            else:
+                with click.progressbar(
+                    notes_iter,
+                    label="Exporting notes",
+                    show_eta=False,
+                    show_pos=True,
+                ) as bar:
+                    for note in bar:
+                        unreturned_note_ids.discard(note["id"])
+                        if (
+                            allowed_note_long_ids is not None
+                            and note.get("folder") not in allowed_note_long_ids
+                        ):
+                            continue
+                        run.saw(note)
+                        if seen_note_ids is not None:
+                            seen_note_ids.add(note["id"])
+                        if existing_updates is not None:
+                            if existing_updates.get(note["id"]) == note.get("updated"):
+                                run.notes_skipped += 1
+                                i += 1
+                                if stop_after and i >= stop_after:
+                                    break
+                                continue
+                        if latest_updated is None or note.get("updated") > latest_updated:
+                            latest_updated = note.get("updated")
+                        # Fix the folder
+                        note["folder"] = folder_long_ids_to_id.get(note["folder"])
+                        with run.phase("write"):
+                            write_note(db, note, minhash=minhash)
+                        run.notes_written += 1
+                        i += 1
+                        if stop_after and i >= stop_after:
+                            break
+
+            # Time spent fetching notes, excluding the time spent writing them
+            run.phases["notes"] = (
+                time.perf_counter() - notes_started - run.phases.get("write", 0)
+            )
+            if unreturned_note_ids and not stop_after:
+                # Moving last_sync past them would mean never fetching them
+                click.echo(
+                    f"{len(unreturned_note_ids)} changed notes could not be "
+                    "fetched, they will be retried next run",
+                    err=True,
+                )
+                latest_updated = None
+                run.status = "partial"
 
         if sync_delete_missing:
             if seen_note_ids is None:
                 return
+            delete_started = time.perf_counter()
             if allowed_note_long_ids is not None:
                 allowed_folder_ids = [
                     folder_long_ids_to_id.get(folder_id)
@@ -445,136 +771,1973 @@ def cli(
                 ]
                 if allowed_folder_ids:
                     placeholders = ", ".join("?" for _ in allowed_folder_ids)
-                    db.execute(
-                        f"delete from notes where folder in ({placeholders}) and id not in (select value from json_each(?))",
+                    run.notes_deleted = db.execute(
+                        f"delete from notes where folder in ({placeholders}) and source is null "
+                        "and id not in (select value from json_each(?))",
                         tuple(allowed_folder_ids) + (json.dumps(sorted(seen_note_ids)),),
-                    )
+                    ).rowcount
             else:
-                db.execute(
-                    "delete from notes where id not in (select value from json_each(?))",
+                # Notes merged from other NoteStore files are never in Notes
+                run.notes_deleted = db.execute(
+                    "delete from notes where source is null "
+                    "and id not in (select value from json_each(?))",
                     (json.dumps(sorted(seen_note_ids)),),
-                )
+                ).rowcount
+            prune_unused_tags(db)
+            run.phases["delete"] = time.perf_counter() - delete_started
         if latest_updated and not stop_after:
             db["sync_state"].insert(
                 {"key": "last_sync", "value": latest_updated},
                 pk="key",
                 replace=True,
             )
+        if not stop_after and not replay and pending_body_count(db):
+            # Includes bodies left pending by an earlier interrupted run
+            click.echo("Fetching note bodies…", err=True)
+            deadline = run.clock + max_duration if max_duration else None
+            with run.phase("bodies"):
+                hydrate_bodies(
+                    db, recorder=recorder, minhash=minhash, run=run, deadline=deadline
+                )
+            pending = pending_body_count(db) if deadline is not None else 0
+            if pending:
+                save_resume(db, {"remaining": 0, "pending_bodies": pending})
+                click.echo(
+                    f"Time budget used up, {pending} note bodies left for the next run",
+                    err=True,
+                )
+                run.status = "partial"
+                return
+        if run.status != "partial":
+            run.status = "completed"
 
 
-def count_notes():
-    return int(
-        subprocess.check_output(
-            ["osascript", "-e", COUNT_SCRIPT], stderr=subprocess.STDOUT
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+)
+@click.option(
+    "--threshold",
+    type=click.FloatRange(0, 1),
+    default=DEFAULT_DUPLICATE_THRESHOLD,
+    show_default=True,
+    help="Minimum estimated similarity for two notes to be duplicates",
+)
+def duplicates(db_path, threshold):
+    """
+    List clusters of duplicate and near-duplicate notes
+
+    Signatures are computed for any notes added or changed since they were
+    last computed, then each cluster is output as a line of JSON.
+    """
+    db = sqlite_utils.Database(db_path)
+    ensure_schema(db)
+    refreshed = refresh_minhashes(db)
+    if refreshed:
+        click.echo(f"Computed signatures for {refreshed} notes", err=True)
+    for cluster in find_duplicate_clusters(db, threshold=threshold):
+        notes = [
+            db["notes"].get(note_id) for note_id in cluster
+        ]
+        click.echo(
+            json.dumps(
+                {
+                    "notes": [
+                        {
+                            "id": note["id"],
+                            "title": note["title"],
+                            "folder": note["folder"],
+                            "updated": note["updated"],
+                        }
+                        for note in notes
+                    ]
+                }
+            )
         )
-        .decode("utf8")
-        .strip()
-    )
 
 
-def should_use_notestore():
-    env = os.environ.get("APPLE_NOTES_TO_SQLITE_USE_NOTESTORE")
-    if env is not None and env.lower() in {"0", "false", "no"}:
-        return False
-    return DEFAULT_NOTESTORE_PATH.exists()
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+)
+@click.option(
+    "--since",
+    type=int,
+    default=0,
+    show_default=True,
+    help="Only output changes with a sequence number greater than this",
+)
+@click.option("--limit", type=int, help="Output at most this many changes")
+@click.option(
+    "--latest",
+    is_flag=True,
+    help="Only output the most recent change for each row",
+)
+def changes(db_path, since, limit, latest):
+    """
+    Output changes recorded by 'export --changes' as newline-delimited JSON
 
+    Store the highest seq you have processed and pass it to --since next
+    time to receive only newer changes. Delete changes are tombstones that
+    carry the last known values of the deleted row.
+    """
+    db = sqlite_utils.Database(db_path)
+    if not db["changes"].exists():
+        raise click.ClickException(
+            "No changes recorded - run export with --changes first"
+        )
+    for change in read_changes(db, since=since, limit=limit, latest=latest):
+        click.echo(json.dumps(change))
 
-def count_notes_for_folders(folder_pks):
-    if not folder_pks or not should_use_notestore():
-        return None
-    placeholders = ",".join("?" for _ in folder_pks)
-    con = sqlite3.connect(str(DEFAULT_NOTESTORE_PATH))
-    row = con.execute(
-        "SELECT count(*) FROM ZICCLOUDSYNCINGOBJECT WHERE Z_ENT=12 AND ZFOLDER IN ({})".format(
-            placeholders
-        ),
-        folder_pks,
-    ).fetchone()
-    con.close()
-    return row[0]
 
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+)
+@click.argument(
+    "notestore_paths",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    nargs=-1,
+    required=True,
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(1),
+    default=4,
+    show_default=True,
+    help="Number of stores to read at the same time",
+)
+@click.option(
+    "--full",
+    is_flag=True,
+    help="Ingest every store, even those unchanged since they were last ingested",
+)
+def merge(db_path, notestore_paths, workers, full):
+    """
+    Merge NoteStore.sqlite files, e.g. from other machines or backups, into
+    one database
+
+    Example usage:
+
+        apple-notes-to-sqlite merge notes.db backup1/NoteStore.sqlite backup2/NoteStore.sqlite
 
-def iter_process_lines(process):
-    if process.stdout is None:
+    Stores are read in parallel, directly from the SQLite files, so the
+    Notes app is not needed. Note bodies are stored as plain text. The
+    source column records which store each note and folder came from.
+    When several stores contain the same note, the most recently modified
+    version is kept.
+    """
+    db = sqlite_utils.Database(db_path)
+    ensure_schema(db)
+    minhash = db["note_minhashes"].exists()
+    pending = {}
+    for path in notestore_paths:
+        source = str(Path(path).resolve())
+        fingerprint = NoteStoreSnapshot(path).fingerprint()
+        key = f"notestore_fingerprint:{source}"
+        try:
+            previous = db["sync_state"].get(key)["value"]
+        except sqlite_utils.db.NotFoundError:
+            previous = None
+        if previous == fingerprint and not full:
+            click.echo(f"Skipping unchanged {path}", err=True)
+            continue
+        pending[source] = (path, fingerprint)
+    if not pending:
         return
-    for line in process.stdout:
-        yield line
-    process.wait()
+    existing_updates = {
+        row["id"]: row["updated"] for row in db.query("select id, updated from notes")
+    }
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(workers, len(pending))
+    ) as executor:
+        futures = {
+            executor.submit(read_notestore, path): source
+            for source, (path, _) in pending.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            source = futures[future]
+            path, fingerprint = pending[source]
+            folders, notes = future.result()
+            folder_long_ids_to_id = write_folders(
+                db, FolderTree(folders), source=source
+            )
+            written = 0
+            for note in notes:
+                existing = existing_updates.get(note["id"])
+                # Keep whichever copy of a note was modified most recently
+                if existing is not None and (note["updated"] or "") <= existing:
+                    continue
+                note["folder"] = folder_long_ids_to_id.get(note["folder"])
+                note["source"] = source
+                write_note(db, note, minhash=minhash)
+                existing_updates[note["id"]] = note["updated"]
+                written += 1
+            db["sync_state"].insert(
+                {"key": f"notestore_fingerprint:{source}", "value": fingerprint},
+                pk="key",
+                replace=True,
+            )
+            click.echo(
+                f"Merged {path}: {len(notes)} notes, {written} written", err=True
+            )
 
 
-def extract_notes(since=None):
-    split = secrets.token_hex(8)
-    if since:
-        since = since.replace("T", " ")
-        script = EXTRACT_SCRIPT_SINCE.format(split=split, since=since)
-    else:
-        script = EXTRACT_SCRIPT.format(split=split)
-    process = subprocess.Popen(
-        ["osascript", "-e", script],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-    )
-    # Read line by line
-    note = {}
-    body = []
-    for line in iter_process_lines(process):
-        line = line.decode("mac_roman").strip()
-        if line == f"{split}{split}":
-            if note.get("id"):
-                note["body"] = "\n".join(body).strip()
-                yield note
-            note = {}
-            body = []
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+)
+@click.option(
+    "--limit",
+    type=click.IntRange(1),
+    default=20,
+    show_default=True,
+    help="Number of recent runs to show",
+)
+@click.option(
+    "--window",
+    type=click.IntRange(1),
+    default=DEFAULT_HISTORY_WINDOW,
+    show_default=True,
+    help="Number of earlier runs of the same mode to take the median of",
+)
+@click.option(
+    "--slow-factor",
+    type=click.FloatRange(1),
+    default=DEFAULT_SLOW_FACTOR,
+    show_default=True,
+    help="Flag runs that took longer than this multiple of the median",
+)
+@click.option("--json", "as_json", is_flag=True, help="Output newline-delimited JSON")
+def history(db_path, limit, window, slow_factor, as_json):
+    """
+    Show recent export runs, flagging runs that were slower than usual
+
+    Each run is compared with the median duration of the completed runs of
+    the same mode (full, incremental, folder-scoped, delete-missing, verify,
+    metadata-first or budgeted) that came before it.
+    """
+    db = sqlite_utils.Database(db_path)
+    if not db["sync_runs"].exists():
+        raise click.ClickException("No runs recorded yet")
+    runs = sync_run_history(db, window=window, slow_factor=slow_factor)[-limit:]
+    for run in runs:
+        if as_json:
+            click.echo(json.dumps(run))
             continue
-        found_key = False
-        for key in ("id", "title", "folder", "created", "updated"):
-            if line.startswith(f"{split}-{key}: "):
-                note[key] = line[len(f"{split}-{key}: ") :]
-                found_key = True
-                continue
-        if not found_key:
-            body.append(line)
+        line = (
+            "{started}  {mode:<14} {status:<10} {duration:8.1f}s  "
+            "seen {notes_seen}, written {notes_written}, "
+            "skipped {notes_skipped}, deleted {notes_deleted}".format(**run)
+        )
+        if run["peak_rss"]:
+            line += f", peak RSS {run['peak_rss'] / 1024 / 1024:.0f}MB"
+        if run["slow"]:
+            line += f"  SLOW (median {run['median_duration']:.1f}s)"
+        click.echo(line)
+    durations = {}
+    for run in runs:
+        if run["status"] == "completed":
+            durations.setdefault(run["mode"], []).append(run["duration"])
+    if not as_json:
+        for mode, values in sorted(durations.items()):
+            click.echo(
+                f"{mode}: {len(values)} runs, median {statistics.median(values):.1f}s, "
+                f"latest {values[-1]:.1f}s",
+                err=True,
+            )
 
 
-def get_coredata_base():
-    coredata_id = (
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+)
+@click.option(
+    "--limit",
+    type=click.IntRange(1),
+    help="Fetch at most this many bodies",
+)
+def hydrate(db_path, limit):
+    """
+    Fetch the bodies of notes written by 'export --metadata-first' that are
+    still pending, most recently modified first
+    """
+    db = sqlite_utils.Database(db_path)
+    ensure_schema(db)
+    pending = pending_body_count(db)
+    if not pending:
+        click.echo("No pending note bodies", err=True)
+        return
+    fetched = hydrate_bodies(
+        db, limit=limit, minhash=db["note_minhashes"].exists()
+    )
+    click.echo(f"Fetched {fetched} of {pending} pending note bodies", err=True)
+
+
+@cli.command(name="export-files")
+@click.argument(
+    "db_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, allow_dash=False),
+)
+@click.argument(
+    "output_dir",
+    type=click.Path(file_okay=False, dir_okay=True),
+)
+@click.option(
+    "--format",
+    "file_format",
+    type=click.Choice(["markdown", "html"]),
+    default="markdown",
+    show_default=True,
+    help="Format of the note files",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(1),
+    default=8,
+    show_default=True,
+    help="Number of files to write at the same time",
+)
+def export_files(db_path, output_dir, file_format, workers):
+    """
+    Mirror the notes in a database to one file per note, in directories
+    that follow the folder hierarchy
+
+    Example usage:
+
+        apple-notes-to-sqlite export-files notes.db notes/
+
+    Only notes that changed since the last run are written. Notes in
+    renamed or moved folders are moved rather than rewritten, and files for
+    deleted notes are removed.
+    """
+    db = sqlite_utils.Database(db_path)
+    ensure_schema(db)
+    counts = sync_note_files(db, output_dir, file_format, workers=workers)
+    click.echo(
+        "Wrote {written}, moved {moved}, removed {removed}, "
+        "unchanged {unchanged}".format(**counts),
+        err=True,
+    )
+
+
+def ensure_schema(db):
+    if not db["folders"].exists():
+        db["folders"].create(
+            {
+                "id": int,
+                "long_id": str,
+                "name": str,
+                "parent": int,
+            },
+            pk="id",
+        )
+        db["folders"].create_index(["long_id"], unique=True)
+        db["folders"].add_foreign_key("parent", "folders", "id")
+    if not db["notes"].exists():
+        db["notes"].create(
+            {
+                "id": str,
+                "created": str,
+                "updated": str,
+                "folder": int,
+                "title": str,
+                "body": str,
+            },
+            pk="id",
+        )
+        db["notes"].add_foreign_key("folder", "folders", "id")
+    if not db["sync_state"].exists():
+        db["sync_state"].create({"key": str, "value": str}, pk="key")
+    migrate(db)
+
+
+# Schema migrations, applied in order. The number of migrations applied so
+# far is stored as the schema_version row in sync_state. Only ever append
+# to this list - existing databases rely on the positions.
+MIGRATIONS = []
+
+WATERMARK_BUMP = """
+    UPDATE sync_state SET value = CAST(value AS INTEGER) + 1
+    WHERE key = 'watermark';
+"""
+
+
+def migration(fn):
+    """
+    Register a schema migration. migrate() runs each one in a single
+    transaction with its schema_version bump, but sqlite-utils table methods
+    can commit part way through, so a migration must also be safe to re-run
+    """
+    MIGRATIONS.append(fn)
+    return fn
+
+
+@contextlib.contextmanager
+def transaction(db):
+    """
+    Commit on success and roll back on error. Inside a transaction that is
+    already open, such as a migration, use a savepoint instead so that only
+    the outermost transaction commits
+    """
+    if not db.conn.in_transaction:
+        db.conn.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            db.conn.rollback()
+            raise
+        db.conn.commit()
+        return
+    savepoint = "sp_{}".format(secrets.token_hex(4))
+    db.conn.execute("SAVEPOINT {}".format(savepoint))
+    try:
+        yield
+    except BaseException:
+        db.conn.execute("ROLLBACK TO {}".format(savepoint))
+        db.conn.execute("RELEASE {}".format(savepoint))
+        raise
+    db.conn.execute("RELEASE {}".format(savepoint))
+
+
+@migration
+def m001_query_indexes(db):
+    # notes.folder drives folder-scoped deletes, notes.updated change queries
+    db["notes"].create_index(["folder"], if_not_exists=True)
+    db["notes"].create_index(["updated"], if_not_exists=True)
+
+
+@migration
+def m002_folder_hierarchy(db):
+    if "path" not in db["folders"].columns_dict:
+        db["folders"].add_column("path", str)
+    db["folders"].create_index(["path"], if_not_exists=True)
+    db["folder_closure"].create(
+        {"ancestor": int, "descendant": int, "depth": int},
+        pk=("ancestor", "descendant"),
+        if_not_exists=True,
+    )
+    db["folder_closure"].create_index(["descendant"], if_not_exists=True)
+    update_folder_hierarchy(db)
+
+
+@migration
+def m003_tags(db):
+    db["tags"].create(
+        {"id": int, "key": str, "name": str}, pk="id", if_not_exists=True
+    )
+    db["tags"].create_index(["key"], unique=True, if_not_exists=True)
+    db["note_tags"].create(
+        {"note_id": str, "tag_id": int},
+        pk=("note_id", "tag_id"),
+        foreign_keys=[("note_id", "notes", "id"), ("tag_id", "tags", "id")],
+        if_not_exists=True,
+    )
+    db["note_tags"].create_index(["tag_id"], if_not_exists=True)
+    db.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS notes_delete_note_tags
+        AFTER DELETE ON notes
+        BEGIN
+            DELETE FROM note_tags WHERE note_id = old.id;
+        END
+        """
+    )
+    for row in db.query("select id, body from notes"):
+        update_note_tags(db, row["id"], row["body"])
+
+
+@migration
+def m004_folder_stats(db):
+    db["folder_stats"].create(
+        {
+            "folder_id": int,
+            "note_count": int,
+            "total_bytes": int,
+            "last_updated": str,
+        },
+        pk="folder_id",
+        foreign_keys=[("folder_id", "folders", "id")],
+        if_not_exists=True,
+    )
+    # Each trigger adjusts the stats of every ancestor of the affected folder.
+    # No OR IGNORE: a conflict clause on the outer upsert would override it
+    add_note = """
+        INSERT INTO folder_stats (folder_id, note_count, total_bytes)
+        SELECT ancestor, 0, 0 FROM folder_closure
+        WHERE descendant = new.folder AND ancestor NOT IN (
+            SELECT folder_id FROM folder_stats
+        );
+        UPDATE folder_stats SET
+            note_count = note_count + 1,
+            total_bytes = total_bytes + coalesce(length(CAST(new.body AS BLOB)), 0),
+            last_updated = CASE
+                WHEN last_updated IS NULL OR new.updated > last_updated
+                THEN new.updated ELSE last_updated END
+        WHERE folder_id IN (
+            SELECT ancestor FROM folder_closure WHERE descendant = new.folder
+        );
+    """
+    remove_note = """
+        UPDATE folder_stats SET
+            note_count = note_count - 1,
+            total_bytes = total_bytes - coalesce(length(CAST(old.body AS BLOB)), 0)
+        WHERE folder_id IN (
+            SELECT ancestor FROM folder_closure WHERE descendant = old.folder
+        );
+        UPDATE folder_stats SET last_updated = (
+            SELECT max(notes.updated) FROM notes
+            JOIN folder_closure ON notes.folder = folder_closure.descendant
+            WHERE folder_closure.ancestor = folder_stats.folder_id
+        )
+        WHERE last_updated = old.updated AND folder_id IN (
+            SELECT ancestor FROM folder_closure WHERE descendant = old.folder
+        );
+    """
+    # One statement at a time: executescript() would commit the migration
+    for trigger in (
+        f"""
+        CREATE TRIGGER IF NOT EXISTS notes_insert_folder_stats
+        AFTER INSERT ON notes
+        BEGIN {add_note} END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS notes_delete_folder_stats
+        AFTER DELETE ON notes
+        BEGIN {remove_note} END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS notes_update_folder_stats
+        AFTER UPDATE OF folder, body, updated ON notes
+        WHEN old.folder IS NOT new.folder
+            OR old.body IS NOT new.body
+            OR old.updated IS NOT new.updated
+        BEGIN {remove_note} {add_note} END
+        """,
+    ):
+        db.conn.execute(trigger)
+    rebuild_folder_stats(db)
+
+
+def rebuild_folder_stats(db):
+    "Recompute folder_stats from scratch, e.g. after folders have moved"
+    with transaction(db):
+        db.execute("delete from folder_stats")
+        db.execute(
+            """
+            insert into folder_stats (folder_id, note_count, total_bytes, last_updated)
+            select
+                folder_closure.ancestor,
+                count(notes.id),
+                coalesce(sum(length(cast(notes.body as blob))), 0),
+                max(notes.updated)
+            from folder_closure
+            left join notes on notes.folder = folder_closure.descendant
+            group by folder_closure.ancestor
+            """
+        )
+
+
+def ensure_folder_stats_rows(db):
+    with transaction(db):
+        db.execute(
+            """
+            insert or ignore into folder_stats (folder_id, note_count, total_bytes)
+            select id, 0, 0 from folders
+            """
+        )
+
+
+@migration
+def m005_source(db):
+    # Which NoteStore a row was merged from, null for the local Notes app
+    for table in ("folders", "notes"):
+        if "source" not in db[table].columns_dict:
+            db[table].add_column("source", str)
+
+
+@migration
+def m006_sync_runs(db):
+    db["sync_runs"].create(
+        {
+            "id": int,
+            "started": str,
+            "finished": str,
+            "mode": str,
+            "status": str,
+            "duration": float,
+            "notes_seen": int,
+            "notes_written": int,
+            "notes_skipped": int,
+            "notes_deleted": int,
+            "bytes_extracted": int,
+            "phases": str,
+            "peak_rss": int,
+        },
+        pk="id",
+        if_not_exists=True,
+    )
+
+
+@migration
+def m007_body_status(db):
+    # 'pending' until a note written by --metadata-first has its body fetched
+    if "body_status" not in db["notes"].columns_dict:
+        db["notes"].add_column("body_status", str)
+    with transaction(db):
+        db.execute("update notes set body_status = 'complete' where body_status is null")
+        db.execute(
+            "create index if not exists notes_pending_bodies on notes(updated) "
+            "where body_status = 'pending'"
+        )
+
+
+@migration
+def m008_watermark(db):
+    # Bumped by every change to notes or folders, so readers such as
+    # NotesIndex can tell when cached rows are stale
+    db["sync_state"].insert({"key": "watermark", "value": "0"}, pk="key", ignore=True)
+    with transaction(db):
+        for table in ("notes", "folders"):
+            for event in ("insert", "update", "delete"):
+                db.execute(
+                    f"CREATE TRIGGER IF NOT EXISTS {table}_watermark_{event} "
+                    f"AFTER {event.upper()} ON {table} BEGIN {WATERMARK_BUMP} END"
+                )
+
+
+@migration
+def m009_watermark_only_on_change(db):
+    # Every export upserts every folder: rewriting a row with the same
+    # values must not move the watermark
+    columns = {
+        "notes": (
+            "created",
+            "updated",
+            "folder",
+            "title",
+            "body",
+            "source",
+            "body_status",
+        ),
+        "folders": ("long_id", "name", "parent", "path", "source"),
+    }
+    with transaction(db):
+        for table, table_columns in columns.items():
+            changed = " OR ".join(
+                f"old.{column} IS NOT new.{column}" for column in table_columns
+            )
+            db.execute(f"DROP TRIGGER IF EXISTS {table}_watermark_update")
+            db.execute(
+                f"CREATE TRIGGER {table}_watermark_update AFTER UPDATE ON {table} "
+                f"WHEN {changed} BEGIN {WATERMARK_BUMP} END"
+            )
+
+
+def get_schema_version(db):
+    try:
+        row = db["sync_state"].get("schema_version")
+    except sqlite_utils.db.NotFoundError:
+        return 0
+    return int(row["value"])
+
+
+def migrate(db):
+    "Apply any pending migrations, returning the names of those applied"
+    version = get_schema_version(db)
+    applied = []
+    for fn in MIGRATIONS[version:]:
+        with transaction(db):
+            fn(db)
+            version += 1
+            db["sync_state"].insert(
+                {"key": "schema_version", "value": str(version)},
+                pk="key",
+                replace=True,
+            )
+        applied.append(fn.__name__)
+    if applied and db["notes"].count:
+        # Existing data: refresh planner statistics so the new structures
+        # are picked up straight away
+        db.execute("ANALYZE")
+    return applied
+
+
+def write_folders(db, tree, allowed_folder_long_ids=None, source=None):
+    """
+    Write the folders in a FolderTree, parents first, keeping the IDs of
+    folders already in the database. Returns a map of long_id to ID.
+    """
+    existing_folder_ids = {
+        row["long_id"]: row["id"]
+        for row in db.query("select id, long_id from folders")
+    }
+    folder_long_ids_to_id = {}
+    for folder in tree.topological_order():
+        if (
+            allowed_folder_long_ids is not None
+            and folder.get("long_id") not in allowed_folder_long_ids
+        ):
+            continue
+        parent = folder.get("parent")
+        if allowed_folder_long_ids is not None and parent not in allowed_folder_long_ids:
+            parent = None
+        folder_db = {k: v for k, v in folder.items() if k != "pk"}
+        folder_db["parent"] = folder_long_ids_to_id.get(
+            parent, existing_folder_ids.get(parent)
+        )
+        if source is not None:
+            folder_db["source"] = source
+        id = existing_folder_ids.get(folder["long_id"])
+        if id is not None:
+            # Keep existing IDs stable so notes.folder stays valid
+            db["folders"].upsert(dict(folder_db, id=id), pk="id")
+        else:
+            id = db["folders"].insert(folder_db, pk="id").last_pk
+        folder_long_ids_to_id[folder["long_id"]] = id
+    closure_removed, closure_added = update_folder_hierarchy(db)
+    new_folder_ids = set(folder_long_ids_to_id.values()) - set(
+        existing_folder_ids.values()
+    )
+    if closure_removed or any(
+        descendant not in new_folder_ids for _, descendant in closure_added
+    ):
+        # Existing folders moved: roll-ups must be recomputed
+        rebuild_folder_stats(db)
+    elif new_folder_ids:
+        ensure_folder_stats_rows(db)
+    return folder_long_ids_to_id
+
+
+def write_note(db, note, minhash=False):
+    # An upsert rather than a replace, so that update triggers fire
+    db["notes"].upsert(
+        dict(note, body_status="complete"),
+        pk="id",
+        alter=True,
+    )
+    update_note_tags(db, note["id"], note.get("body"))
+    if minhash:
+        update_note_minhash(db, note["id"], note.get("updated"), note.get("body"))
+
+
+def sync_note_metadata(
+    db,
+    folder_long_ids_to_id,
+    existing_updates=None,
+    note_folder_long_ids=None,
+    seen_note_ids=None,
+    recorder=None,
+    run=None,
+):
+    """
+    Write the title, dates and folder of new and changed notes without
+    their bodies, which are marked as pending. Returns the latest updated
+    value written.
+    """
+    latest_updated = None
+    changed = []
+    for note in extract_note_metadata(recorder=recorder):
+        if (
+            note_folder_long_ids is not None
+            and note.get("folder") not in note_folder_long_ids
+        ):
+            continue
+        if run is not None:
+            run.saw(note)
+        if seen_note_ids is not None:
+            seen_note_ids.add(note["id"])
+        if existing_updates is not None:
+            if existing_updates.get(note["id"]) == note.get("updated"):
+                if run is not None:
+                    run.notes_skipped += 1
+                continue
+        if latest_updated is None or note.get("updated") > latest_updated:
+            latest_updated = note.get("updated")
+        note["folder"] = folder_long_ids_to_id.get(note["folder"])
+        note["body_status"] = "pending"
+        changed.append(note)
+    # Existing rows keep their old body until the new one is fetched
+    db["notes"].upsert_all(changed, pk="id", alter=True)
+    if run is not None:
+        run.notes_written += len(changed)
+    return latest_updated
+
+
+def sync_notes_within_budget(
+    db,
+    folder_long_ids_to_id,
+    deadline,
+    existing_updates=None,
+    note_folder_long_ids=None,
+    notestore=None,
+    recorder=None,
+    replay=None,
+    minhash=False,
+    run=None,
+):
+    """
+    Write new and changed notes, most recently modified first, until
+    time.perf_counter() passes the deadline. Each note is committed as it
+    is written. Returns the latest updated value written and the metadata
+    of the notes that were not reached, newest first.
+    """
+    existing_updates = existing_updates or {}
+    if replay:
+        source_notes = list(replay_notes(replay))
+        bodies = {note["id"]: note for note in source_notes}
+    elif notestore is not None:
+        source_notes = note_metadata_from_notestore(notestore)
+    else:
+        source_notes = extract_note_metadata(recorder=recorder)
+    queue = sorted(
+        (
+            note
+            for note in source_notes
+            if (
+                note_folder_long_ids is None
+                or note.get("folder") in note_folder_long_ids
+            )
+            and existing_updates.get(note["id"]) != note.get("updated")
+        ),
+        key=lambda note: note.get("updated") or "",
+        reverse=True,
+    )
+    if replay:
+        notes = (bodies[note["id"]] for note in queue)
+    else:
+        notes = extract_notes_by_ids(
+            [note["id"] for note in queue], recorder=recorder
+        )
+    latest_updated = None
+    written = set()
+    stopped_early = False
+    for note in notes:
+        if run is not None:
+            run.saw(note)
+        if latest_updated is None or note.get("updated") > latest_updated:
+            latest_updated = note.get("updated")
+        note["folder"] = folder_long_ids_to_id.get(note["folder"])
+        write_note(db, note, minhash=minhash)
+        written.add(note["id"])
+        if run is not None:
+            run.notes_written += 1
+        if time.perf_counter() >= deadline:
+            stopped_early = True
+            break
+    notes.close()
+    if not stopped_early:
+        return latest_updated, []
+    # Notes arrive in queue order, so everything after the last one written
+    # was not reached
+    last = max(index for index, note in enumerate(queue) if note["id"] in written)
+    return latest_updated, queue[last + 1 :]
+
+
+def pending_body_count(db):
+    if "body_status" not in db["notes"].columns_dict:
+        return 0
+    return db.execute(
+        "select count(*) from notes where body_status = 'pending'"
+    ).fetchone()[0]
+
+
+def save_resume(db, resume):
+    "Record where a --max-duration run stopped, for the next run"
+    db["sync_state"].insert(
+        {"key": "resume", "value": json.dumps(resume)}, pk="key", replace=True
+    )
+
+
+def hydrate_bodies(
+    db, limit=None, recorder=None, minhash=False, run=None, deadline=None
+):
+    """
+    Fetch pending note bodies, most recently modified first, stopping once
+    time.perf_counter() passes the deadline, if one is given
+    """
+    sql = "select id from notes where body_status = 'pending' order by updated desc"
+    if limit:
+        sql += f" limit {int(limit)}"
+    note_ids = [row["id"] for row in db.query(sql)]
+    folder_long_ids_to_id = {
+        row["long_id"]: row["id"] for row in db.query("select id, long_id from folders")
+    }
+    fetched = 0
+
+    def out_of_time():
+        return deadline is not None and time.perf_counter() >= deadline
+
+    def fetch(batch):
+        "Write the notes in batch, returning the IDs that did not come back"
+        nonlocal fetched
+        returned = set()
+        notes = extract_notes_by_ids(batch, recorder=recorder)
+        for note in notes:
+            note["folder"] = folder_long_ids_to_id.get(note["folder"])
+            write_note(db, note, minhash=minhash)
+            if run is not None:
+                run.bytes_extracted += len((note.get("body") or "").encode("utf8"))
+            returned.add(note["id"])
+            fetched += 1
+            if out_of_time():
+                break
+        notes.close()
+        return [note_id for note_id in batch if note_id not in returned]
+
+    for start in range(0, len(note_ids), NOTE_ID_BATCH_SIZE):
+        if out_of_time():
+            break
+        batch = note_ids[start : start + NOTE_ID_BATCH_SIZE]
+        not_returned = fetch(batch)
+        if len(batch) > 1:
+            # A note deleted from Notes aborts the script for the rest of its
+            # batch, so retry the notes that did not come back one at a time.
+            # Notes not retried before the deadline stay pending.
+            retried = []
+            for note_id in not_returned:
+                if out_of_time():
+                    break
+                if fetch([note_id]):
+                    retried.append(note_id)
+            not_returned = retried
+        if not_returned:
+            # Gone from Notes: stop retrying them on every run
+            with db.conn:
+                db.execute(
+                    "update notes set body_status = 'missing' "
+                    "where id in (select value from json_each(?))",
+                    (json.dumps(not_returned),),
+                )
+    return fetched
+
+
+def extract_hashtags(body):
+    "Map of case-folded key to display name for each #hashtag in body"
+    text = html.unescape(HTML_TAG_RE.sub(" ", body or ""))
+    tags = {}
+    for match in HASHTAG_RE.finditer(text):
+        name = match.group(1).rstrip("-")
+        tags.setdefault(name.casefold(), name)
+    return tags
+
+
+def update_note_tags(db, note_id, body):
+    tags = extract_hashtags(body)
+    with transaction(db):
+        db.execute("delete from note_tags where note_id = ?", (note_id,))
+        if not tags:
+            return
+        db.conn.executemany(
+            "insert or ignore into tags (key, name) values (?, ?)", tags.items()
+        )
+        db.execute(
+            """
+            insert or ignore into note_tags (note_id, tag_id)
+            select ?, id from tags where key in (select value from json_each(?))
+            """,
+            (note_id, json.dumps(list(tags))),
+        )
+
+
+def prune_unused_tags(db):
+    with db.conn:
+        db.execute(
+            "delete from tags where id not in (select tag_id from note_tags)"
+        )
+
+
+def ensure_minhash_tables(db):
+    db["note_minhashes"].create(
+        {"note_id": str, "updated": str, "signature": bytes},
+        pk="note_id",
+        if_not_exists=True,
+    )
+    db["note_lsh_buckets"].create(
+        {"band": int, "bucket": int, "note_id": str},
+        pk=("band", "bucket", "note_id"),
+        if_not_exists=True,
+    )
+    db["note_lsh_buckets"].create_index(["note_id"], if_not_exists=True)
+    db.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS notes_delete_minhash
+        AFTER DELETE ON notes
+        BEGIN
+            DELETE FROM note_minhashes WHERE note_id = old.id;
+            DELETE FROM note_lsh_buckets WHERE note_id = old.id;
+        END
+        """
+    )
+
+
+def _stable_hash(value):
+    digest = hashlib.blake2b(value, digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def minhash_signature(body):
+    "MinHash signature over word shingles of the note text, or None if empty"
+    text = html.unescape(HTML_TAG_RE.sub(" ", body or "")).casefold()
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    size = min(MINHASH_SHINGLE_SIZE, len(words))
+    shingles = {
+        _stable_hash(" ".join(words[i : i + size]).encode("utf8")) & MINHASH_PRIME
+        for i in range(len(words) - size + 1)
+    }
+    return [
+        min((a * shingle + b) % MINHASH_PRIME for shingle in shingles)
+        for a, b in MINHASH_PERMUTATIONS
+    ]
+
+
+def minhash_similarity(signature1, signature2):
+    "Estimated Jaccard similarity of two signatures"
+    matches = sum(1 for x, y in zip(signature1, signature2) if x == y)
+    return matches / len(signature1)
+
+
+def lsh_buckets(signature):
+    "Yield (band, bucket) pairs for a signature"
+    rows = len(signature) // MINHASH_BANDS
+    for band in range(MINHASH_BANDS):
+        values = signature[band * rows : (band + 1) * rows]
+        yield band, _stable_hash(array.array("Q", values).tobytes())
+
+
+def update_note_minhash(db, note_id, updated, body):
+    signature = minhash_signature(body)
+    with db.conn:
+        db.execute("delete from note_lsh_buckets where note_id = ?", (note_id,))
+        db.execute(
+            "insert or replace into note_minhashes (note_id, updated, signature) "
+            "values (?, ?, ?)",
+            (
+                note_id,
+                updated,
+                array.array("Q", signature).tobytes() if signature else None,
+            ),
+        )
+        if signature:
+            db.conn.executemany(
+                "insert into note_lsh_buckets (band, bucket, note_id) values (?, ?, ?)",
+                (
+                    (band, bucket, note_id)
+                    for band, bucket in lsh_buckets(signature)
+                ),
+            )
+
+
+def refresh_minhashes(db):
+    "Compute signatures for notes that are new or changed since the last run"
+    ensure_minhash_tables(db)
+    stale = db.query(
+        """
+        select notes.id, notes.updated, notes.body from notes
+        left join note_minhashes on note_minhashes.note_id = notes.id
+        where note_minhashes.note_id is null
+        or note_minhashes.updated is not notes.updated
+        """
+    )
+    count = 0
+    for row in list(stale):
+        update_note_minhash(db, row["id"], row["updated"], row["body"])
+        count += 1
+    return count
+
+
+def find_duplicate_clusters(db, threshold=DEFAULT_DUPLICATE_THRESHOLD):
+    """
+    Group notes whose estimated similarity is at least threshold, using
+    LSH buckets so that only notes sharing a bucket are ever compared
+    """
+    signatures = {}
+
+    def signature(note_id):
+        if note_id not in signatures:
+            row = db.execute(
+                "select signature from note_minhashes where note_id = ?", (note_id,)
+            ).fetchone()
+            signatures[note_id] = array.array("Q", row[0]).tolist()
+        return signatures[note_id]
+
+    parents = {}
+
+    def find(note_id):
+        parents.setdefault(note_id, note_id)
+        root = note_id
+        while parents.get(root, root) != root:
+            root = parents[root]
+        while note_id != root:
+            parents[note_id], note_id = root, parents.get(note_id, note_id)
+        return root
+
+    compared = set()
+    for (note_ids,) in db.execute(
+        """
+        select json_group_array(note_id) from note_lsh_buckets
+        group by band, bucket having count(*) > 1
+        """
+    ):
+        note_ids = sorted(json.loads(note_ids))
+        for i, note_id in enumerate(note_ids):
+            for other_id in note_ids[i + 1 :]:
+                if (note_id, other_id) in compared:
+                    continue
+                compared.add((note_id, other_id))
+                if find(note_id) == find(other_id):
+                    continue
+                similarity = minhash_similarity(
+                    signature(note_id), signature(other_id)
+                )
+                if similarity >= threshold:
+                    parents[find(other_id)] = find(note_id)
+
+    clusters = {}
+    for note_id in parents:
+        clusters.setdefault(find(note_id), set()).add(note_id)
+    return sorted(
+        (sorted(members) for members in clusters.values() if len(members) > 1),
+        key=lambda members: (-len(members), members),
+    )
+
+
+def ensure_changes_table(db):
+    db.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            "table" TEXT NOT NULL,
+            row_id TEXT NOT NULL,
+            op TEXT NOT NULL,
+            tombstone TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_changes_table_row_id
+            ON changes ("table", row_id);
+
+        CREATE TRIGGER IF NOT EXISTS notes_insert_changes
+        AFTER INSERT ON notes
+        BEGIN
+            INSERT INTO changes ("table", row_id, op)
+            VALUES ('notes', new.id, 'insert');
+        END;
+        CREATE TRIGGER IF NOT EXISTS notes_update_changes
+        AFTER UPDATE ON notes
+        WHEN old.updated IS NOT new.updated
+            OR old.folder IS NOT new.folder
+            OR old.title IS NOT new.title
+            OR old.body IS NOT new.body
+            OR old.created IS NOT new.created
+        BEGIN
+            INSERT INTO changes ("table", row_id, op)
+            VALUES ('notes', new.id, 'update');
+        END;
+        CREATE TRIGGER IF NOT EXISTS notes_delete_changes
+        AFTER DELETE ON notes
+        BEGIN
+            INSERT INTO changes ("table", row_id, op, tombstone)
+            VALUES ('notes', old.id, 'delete', json_object(
+                'folder', old.folder, 'title', old.title,
+                'created', old.created, 'updated', old.updated
+            ));
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS folders_insert_changes
+        AFTER INSERT ON folders
+        BEGIN
+            INSERT INTO changes ("table", row_id, op)
+            VALUES ('folders', new.id, 'insert');
+        END;
+        CREATE TRIGGER IF NOT EXISTS folders_update_changes
+        AFTER UPDATE ON folders
+        WHEN old.long_id IS NOT new.long_id
+            OR old.name IS NOT new.name
+            OR old.parent IS NOT new.parent
+            OR old.path IS NOT new.path
+        BEGIN
+            INSERT INTO changes ("table", row_id, op)
+            VALUES ('folders', new.id, 'update');
+        END;
+        CREATE TRIGGER IF NOT EXISTS folders_delete_changes
+        AFTER DELETE ON folders
+        BEGIN
+            INSERT INTO changes ("table", row_id, op, tombstone)
+            VALUES ('folders', old.id, 'delete', json_object(
+                'long_id', old.long_id, 'name', old.name,
+                'parent', old.parent, 'path', old.path
+            ));
+        END;
+        """
+    )
+
+
+def read_changes(db, since=0, limit=None, latest=False):
+    """
+    Yield changes with a sequence number greater than since, oldest first.
+
+    Inserts and updates include the current row, if it still exists, and
+    deletes include the tombstone. With latest=True only the most recent
+    change for each row is returned.
+    """
+    sql = 'select seq, "table", row_id, op, tombstone from changes where seq > ?'
+    if latest:
+        sql += """
+            and seq in (
+                select max(seq) from changes where seq > ? group by "table", row_id
+            )
+        """
+    sql += " order by seq"
+    params = [since, since] if latest else [since]
+    if limit:
+        sql += " limit ?"
+        params.append(limit)
+    for seq, table, row_id, op, tombstone in db.execute(sql, params).fetchall():
+        change = {"seq": seq, "table": table, "id": row_id, "op": op}
+        if op == "delete":
+            change["tombstone"] = json.loads(tombstone) if tombstone else None
+        else:
+            pk = int(row_id) if table == "folders" else row_id
+            try:
+                change["row"] = db[table].get(pk)
+            except sqlite_utils.db.NotFoundError:
+                change["row"] = None
+        yield change
+
+
+def build_merkle_tree(notes):
+    """
+    Hash tree over an iterable of {id, updated, folder} dictionaries.
+
+    Returns (root hash, {folder: (folder hash, {bucket: (bucket hash,
+    {note id: leaf hash})})}), where notes in a folder are spread over
+    buckets by a prefix of the hash of their ID.
+    """
+    folders = {}
+    for note in notes:
+        leaf = hashlib.sha1(
+            "{}\0{}".format(note["id"], note.get("updated")).encode("utf8")
+        ).hexdigest()
+        bucket = hashlib.sha1(note["id"].encode("utf8")).hexdigest()[
+            :MERKLE_BUCKET_PREFIX
+        ]
+        folders.setdefault(note.get("folder"), {}).setdefault(bucket, {})[
+            note["id"]
+        ] = leaf
+
+    def combine(hashes):
+        return hashlib.sha1("".join(hashes).encode("utf8")).hexdigest()
+
+    tree = {}
+    for folder, buckets in folders.items():
+        hashed_buckets = {
+            bucket: (combine(leaves[key] for key in sorted(leaves)), leaves)
+            for bucket, leaves in buckets.items()
+        }
+        folder_hash = combine(
+            bucket + hashed_buckets[bucket][0] for bucket in sorted(hashed_buckets)
+        )
+        tree[folder] = (folder_hash, hashed_buckets)
+    root = combine(
+        str(folder) + tree[folder][0] for folder in sorted(tree, key=str)
+    )
+    return root, tree
+
+
+def diff_merkle_trees(source, mirror):
+    """
+    Compare two trees from build_merkle_tree(), descending only into
+    folders and buckets whose hashes differ. Returns (note IDs that are
+    missing or different in the mirror, note IDs only in the mirror)
+    """
+    source_root, source_folders = source
+    mirror_root, mirror_folders = mirror
+    divergent = set()
+    extra = set()
+    if source_root == mirror_root:
+        return divergent, extra
+    for folder in set(source_folders) | set(mirror_folders):
+        source_hash, source_buckets = source_folders.get(folder, (None, {}))
+        mirror_hash, mirror_buckets = mirror_folders.get(folder, (None, {}))
+        if source_hash == mirror_hash:
+            continue
+        for bucket in set(source_buckets) | set(mirror_buckets):
+            source_bucket_hash, source_leaves = source_buckets.get(bucket, (None, {}))
+            mirror_bucket_hash, mirror_leaves = mirror_buckets.get(bucket, (None, {}))
+            if source_bucket_hash == mirror_bucket_hash:
+                continue
+            for note_id, leaf in source_leaves.items():
+                if mirror_leaves.get(note_id) != leaf:
+                    divergent.add(note_id)
+            extra.update(set(mirror_leaves) - set(source_leaves))
+    # A note that moved folder shows up on both sides of the comparison
+    extra -= divergent
+    return divergent, extra
+
+
+def verify_notes(
+    db,
+    folder_long_ids_to_id,
+    note_folder_long_ids=None,
+    recorder=None,
+    minhash=False,
+    notestore=None,
+):
+    """
+    Compare a hash tree of note metadata from Notes with one built from the
+    database, then fetch notes that differ and delete notes gone from Notes
+    """
+    if notestore is not None:
+        source_notes = note_metadata_from_notestore(notestore)
+    else:
+        source_notes = extract_note_metadata(recorder=recorder)
+    source_notes = [
+        note
+        for note in source_notes
+        if note_folder_long_ids is None or note.get("folder") in note_folder_long_ids
+    ]
+    mirror_notes = [
+        note
+        for note in db.query(
+            """
+            select notes.id, notes.updated, folders.long_id as folder
+            from notes left join folders on folders.id = notes.folder
+            where notes.source is null
+            """
+        )
+        if note_folder_long_ids is None or note["folder"] in note_folder_long_ids
+    ]
+    divergent, extra = diff_merkle_trees(
+        build_merkle_tree(source_notes), build_merkle_tree(mirror_notes)
+    )
+    mirror_ids = {note["id"] for note in mirror_notes}
+    if divergent:
+        for note in extract_notes_by_ids(sorted(divergent), recorder=recorder):
+            note["folder"] = folder_long_ids_to_id.get(note["folder"])
+            write_note(db, note, minhash=minhash)
+    if extra:
+        with db.conn:
+            db.execute(
+                "delete from notes where id in (select value from json_each(?))",
+                (json.dumps(sorted(extra)),),
+            )
+        prune_unused_tags(db)
+    return {
+        "checked": len(source_notes),
+        "changed": len(divergent & mirror_ids),
+        "missing": len(divergent - mirror_ids),
+        "extra": len(extra),
+    }
+
+
+def ensure_file_manifest(db):
+    if not db["file_manifest"].exists():
+        db["file_manifest"].create(
+            {
+                "root": str,
+                "note_id": str,
+                "path": str,
+                "format": str,
+                "updated": str,
+                "hash": str,
+            },
+            pk=("root", "note_id"),
+        )
+
+
+def safe_filename(name):
+    name = re.sub(r'[\x00-\x1f/\\:*?"<>|]', "-", name or "").strip(" .")
+    return name[:100] or "Untitled"
+
+
+def note_file_path(note, file_format):
+    "Relative path of a note's file, unique thanks to a hash of its ID"
+    directories = [
+        safe_filename(part) for part in (note["folder_path"] or "").split("/") if part
+    ]
+    suffix = hashlib.sha1(note["id"].encode("utf8")).hexdigest()[:8]
+    extension = "md" if file_format == "markdown" else "html"
+    filename = f"{safe_filename(note['title'])} {suffix}.{extension}"
+    return "/".join(directories + [filename])
+
+
+def html_to_markdown(body):
+    text = re.sub(r"(?i)<br\s*/?>", "\n", body or "")
+    text = re.sub(r"(?i)<h1[^>]*>", "# ", text)
+    text = re.sub(r"(?i)<li[^>]*>", "- ", text)
+    text = re.sub(r"(?i)</(div|p|h\d|li)>", "\n", text)
+    text = html.unescape(HTML_TAG_RE.sub("", text))
+    return re.sub(r"\n{3,}", "\n\n", text).strip() + "\n"
+
+
+def render_note_file(note, file_format):
+    if file_format == "markdown":
+        front_matter = "".join(
+            f"{key}: {json.dumps(note[key])}\n"
+            for key in ("id", "title", "created", "updated")
+        )
+        return f"---\n{front_matter}---\n\n{html_to_markdown(note['body'])}"
+    return (
+        "<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"utf-8\">\n"
+        f"<title>{html.escape(note['title'] or '')}</title>\n"
+        f"</head>\n<body>\n{note['body'] or ''}\n</body>\n</html>\n"
+    )
+
+
+def write_note_file(root, relative_path, content):
+    path = root / relative_path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Write then rename, so readers never see a half-written file
+    temporary = path.with_name(f".{path.name}.tmp")
+    temporary.write_text(content, encoding="utf8")
+    os.replace(temporary, path)
+
+
+def remove_empty_directories(root, directories):
+    for directory in sorted(directories, key=lambda d: len(d.parts), reverse=True):
+        while directory != root and root in directory.parents:
+            try:
+                directory.rmdir()
+            except OSError:
+                # Not empty, or already gone
+                break
+            directory = directory.parent
+
+
+def sync_note_files(db, output_dir, file_format="markdown", workers=8):
+    """
+    Bring a directory of note files up to date with the notes table, using
+    the file_manifest table to skip notes that have not changed
+    """
+    ensure_file_manifest(db)
+    root = Path(output_dir).resolve()
+    root.mkdir(parents=True, exist_ok=True)
+    manifest = {
+        row["note_id"]: row
+        for row in db["file_manifest"].rows_where("root = ?", [str(root)])
+    }
+    counts = {"written": 0, "moved": 0, "removed": 0, "unchanged": 0}
+    touched_directories = set()
+    manifest_updates = []
+    writes = []
+    seen = set()
+    notes = db.query(
+        """
+        select notes.id, notes.title, notes.created, notes.updated,
+            notes.body, folders.path as folder_path
+        from notes left join folders on folders.id = notes.folder
+        """
+    )
+    for note in notes:
+        seen.add(note["id"])
+        path = note_file_path(note, file_format)
+        previous = manifest.get(note["id"])
+        entry = {
+            "root": str(root),
+            "note_id": note["id"],
+            "path": path,
+            "format": file_format,
+            "updated": note["updated"],
+            "hash": previous["hash"] if previous else None,
+        }
+        old_file = root / previous["path"] if previous else None
+        if (
+            previous
+            and previous["format"] == file_format
+            and previous["updated"] == note["updated"]
+            and old_file.exists()
+        ):
+            if previous["path"] != path:
+                # Renamed note or folder: move the file, don't rewrite it
+                (root / path).parent.mkdir(parents=True, exist_ok=True)
+                os.replace(old_file, root / path)
+                touched_directories.add(old_file.parent)
+                manifest_updates.append(entry)
+                counts["moved"] += 1
+            else:
+                counts["unchanged"] += 1
+            continue
+        content = render_note_file(note, file_format)
+        entry["hash"] = hashlib.sha1(content.encode("utf8")).hexdigest()
+        if previous and old_file.exists():
+            if previous["path"] != path:
+                old_file.unlink()
+                touched_directories.add(old_file.parent)
+            elif previous["hash"] == entry["hash"]:
+                # updated changed but the rendered file did not
+                manifest_updates.append(entry)
+                counts["unchanged"] += 1
+                continue
+        writes.append((path, content))
+        manifest_updates.append(entry)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [
+            executor.submit(write_note_file, root, path, content)
+            for path, content in writes
+        ]:
+            future.result()
+    counts["written"] = len(writes)
+    deleted = [row for note_id, row in manifest.items() if note_id not in seen]
+    for row in deleted:
+        old_file = root / row["path"]
+        if old_file.exists():
+            old_file.unlink()
+        touched_directories.add(old_file.parent)
+    counts["removed"] = len(deleted)
+    remove_empty_directories(root, touched_directories)
+    with db.conn:
+        db["file_manifest"].upsert_all(manifest_updates, pk=("root", "note_id"))
+        db.conn.executemany(
+            "delete from file_manifest where root = ? and note_id = ?",
+            [(str(root), row["note_id"]) for row in deleted],
+        )
+    return counts
+
+
+def extract_notes_from_notestore(notestore):
+    """
+    Yield every note in a NoteStore.sqlite, with the plain text of the note
+    as its body, without using the Notes app
+    """
+    columns = notestore.columns("ZICCLOUDSYNCINGOBJECT")
+    created = "ZCREATIONDATE3" if "ZCREATIONDATE3" in columns else "ZCREATIONDATE1"
+    where = f"n.Z_ENT = ? AND {notestore.not_deleted('n.')}"
+    rows = notestore.execute(
+        f"""
+        SELECT
+            n.Z_PK AS pk, n.ZTITLE1 AS title, n.{created} AS created,
+            n.ZMODIFICATIONDATE1 AS updated, n.ZFOLDER AS folder_pk,
+            d.ZDATA AS data
+        FROM ZICCLOUDSYNCINGOBJECT n
+        LEFT JOIN ZICNOTEDATA d ON d.ZNOTE = n.Z_PK
+        WHERE {where}
+        """,
+        (notestore.entity("ICNote"),),
+    )
+    base = notestore.coredata_base
+    for row in rows:
+        yield {
+            "id": f"{base}/ICNote/p{row['pk']}",
+            "created": iso_timestamp(row["created"]),
+            "updated": iso_timestamp(row["updated"]),
+            "folder": f"{base}/ICFolder/p{row['folder_pk']}"
+            if row["folder_pk"]
+            else None,
+            "title": row["title"],
+            "body": note_text_from_data(row["data"]),
+        }
+
+
+def note_text_from_data(data):
+    """
+    Plain text of a note from the gzipped protobuf in ZICNOTEDATA.ZDATA,
+    found at field 2 (document) > field 3 (note) > field 2 (text)
+    """
+    if not data:
+        return None
+    try:
+        message = gzip.decompress(data)
+        for field in (2, 3, 2):
+            message = _protobuf_field(message, field)
+            if message is None:
+                return None
+        return message.decode("utf8")
+    except (OSError, ValueError, IndexError, UnicodeDecodeError):
+        return None
+
+
+def _protobuf_varint(data, position):
+    result = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+
+
+def _protobuf_field(data, wanted):
+    "Bytes of the first length-delimited field numbered wanted"
+    position = 0
+    while position < len(data):
+        key, position = _protobuf_varint(data, position)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            _, position = _protobuf_varint(data, position)
+        elif wire_type == 1:
+            position += 8
+        elif wire_type == 2:
+            length, position = _protobuf_varint(data, position)
+            if field == wanted:
+                return data[position : position + length]
+            position += length
+        elif wire_type == 5:
+            position += 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+    return None
+
+
+def read_notestore(path):
+    "Read folders and notes from one NoteStore.sqlite, run in a worker thread"
+    notestore = NoteStoreSnapshot(path)
+    try:
+        folders = extract_folders_from_notestore(notestore)
+        notes = list(extract_notes_from_notestore(notestore))
+    finally:
+        notestore.close()
+    return folders, notes
+
+
+def count_notes():
+    return int(
         subprocess.check_output(
-            ["osascript", "-e", 'tell application "Notes" to get id of folder 1'],
-            stderr=subprocess.STDOUT,
+            ["osascript", "-e", COUNT_SCRIPT], stderr=subprocess.STDOUT
         )
         .decode("utf8")
         .strip()
     )
-    match = re.match(r"(x-coredata://[^/]+)/", coredata_id)
-    if not match:
-        raise click.ClickException("Could not determine coredata store identifier")
-    return match.group(1)
 
 
-def extract_notes_for_folders(folder_coredata_ids, since=None):
-    if not folder_coredata_ids:
-        return []
+def should_use_notestore():
+    env = os.environ.get("APPLE_NOTES_TO_SQLITE_USE_NOTESTORE")
+    if env is not None and env.lower() in {"0", "false", "no"}:
+        return False
+    return DEFAULT_NOTESTORE_PATH.exists()
+
+
+def count_notes_for_folders(folder_pks, notestore=None):
+    if not folder_pks or notestore is None:
+        return None
+    placeholders = ",".join("?" for _ in folder_pks)
+    row = notestore.execute(
+        "SELECT count(*) FROM ZICCLOUDSYNCINGOBJECT WHERE Z_ENT = ? AND ZFOLDER IN ({})".format(
+            placeholders
+        ),
+        [notestore.entity("ICNote")] + list(folder_pks),
+    ).fetchone()
+    return row[0]
+
+
+class NoteStoreSnapshot:
+    """
+    A consistent, read-only snapshot of NoteStore.sqlite shared by every
+    NoteStore query in a run.
+
+    The live store is opened read-only and copied with the SQLite backup
+    API, which reads every page inside a single transaction, to a temporary
+    file that is then queried through memory-mapped I/O. The copy is taken
+    on first use, so runs that never query NoteStore never pay for it.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._con = None
+        self._tempdir = None
+        self._entities = {}
+        self._coredata_base = None
+
+    @property
+    def con(self):
+        if self._con is None:
+            source = sqlite3.connect(
+                self.path.resolve().as_uri() + "?mode=ro", uri=True
+            )
+            self._tempdir = tempfile.TemporaryDirectory(
+                prefix="apple-notes-to-sqlite-"
+            )
+            con = sqlite3.connect(os.path.join(self._tempdir.name, "NoteStore.sqlite"))
+            try:
+                source.backup(con)
+            finally:
+                source.close()
+            con.execute(f"PRAGMA mmap_size = {NOTESTORE_MMAP_SIZE}")
+            con.execute("PRAGMA query_only = 1")
+            con.row_factory = sqlite3.Row
+            self._con = con
+        return self._con
+
+    def execute(self, sql, params=()):
+        return self.con.execute(sql, params)
+
+    def entity(self, name):
+        "The Z_ENT value for a Core Data entity such as ICNote or ICFolder"
+        if name not in self._entities:
+            row = self.execute(
+                "SELECT Z_ENT FROM Z_PRIMARYKEY WHERE Z_NAME = ?", (name,)
+            ).fetchone()
+            if not row:
+                raise click.ClickException(
+                    f"Could not find {name} entity in NoteStore.sqlite"
+                )
+            self._entities[name] = row[0]
+        return self._entities[name]
+
+    @property
+    def coredata_base(self):
+        if self._coredata_base is None:
+            # The coredata store identifier is the store's Z_UUID
+            try:
+                row = self.execute("SELECT Z_UUID FROM Z_METADATA").fetchone()
+            except sqlite3.OperationalError:
+                row = None
+            if row and row[0]:
+                self._coredata_base = f"x-coredata://{row[0]}"
+            else:
+                self._coredata_base = get_coredata_base()
+        return self._coredata_base
+
+    def columns(self, table):
+        return {row[1] for row in self.execute(f"PRAGMA table_info([{table}])")}
+
+    def not_deleted(self, prefix=""):
+        "SQL condition that skips notes Notes has marked for deletion"
+        if "ZMARKEDFORDELETION" not in self.columns("ZICCLOUDSYNCINGOBJECT"):
+            return "1"
+        return f"coalesce({prefix}ZMARKEDFORDELETION, 0) = 0"
+
+    def fingerprint(self):
+        "Cheap identifier for the state of the store, from file metadata"
+        parts = []
+        for suffix in ("", "-wal"):
+            path = Path(str(self.path) + suffix)
+            if path.exists():
+                stat = path.stat()
+                parts.append(f"{stat.st_size}:{stat.st_mtime_ns}")
+        return "/".join(parts)
+
+    def close(self):
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+        if self._tempdir is not None:
+            self._tempdir.cleanup()
+            self._tempdir = None
+
+
+def open_notestore():
+    "A snapshot of the default NoteStore.sqlite, or None if it is not in use"
+    if should_use_notestore():
+        return NoteStoreSnapshot(DEFAULT_NOTESTORE_PATH)
+    return None
+
+
+def iter_process_lines(process):
+    if process.stdout is None:
+        return
+    try:
+        for line in process.stdout:
+            yield line
+    except GeneratorExit:
+        # Abandoned part way through, e.g. when a --max-duration runs out
+        process.terminate()
+        raise
+    process.wait()
+
+
+class SyncRun:
+    """
+    Statistics for one export run, appended to the sync_runs table when
+    the run ends, whether or not it completed.
+    """
+
+    def __init__(self):
+        self.started = datetime.datetime.now().isoformat(timespec="seconds")
+        self.clock = time.perf_counter()
+        self.mode = None
+        self.status = "incomplete"
+        self.notes_seen = 0
+        self.notes_written = 0
+        self.notes_skipped = 0
+        self.notes_deleted = 0
+        self.bytes_extracted = 0
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = (
+                self.phases.get(name, 0) + time.perf_counter() - started
+            )
+
+    def saw(self, note):
+        self.notes_seen += 1
+        self.bytes_extracted += len((note.get("body") or "").encode("utf8"))
+
+    def finish(self, db):
+        db["sync_runs"].insert(
+            {
+                "started": self.started,
+                "finished": datetime.datetime.now().isoformat(timespec="seconds"),
+                "mode": self.mode,
+                "status": self.status,
+                "duration": round(time.perf_counter() - self.clock, 3),
+                "notes_seen": self.notes_seen,
+                "notes_written": self.notes_written,
+                "notes_skipped": self.notes_skipped,
+                "notes_deleted": self.notes_deleted,
+                "bytes_extracted": self.bytes_extracted,
+                "phases": json.dumps(
+                    {name: round(value, 3) for name, value in self.phases.items()}
+                ),
+                "peak_rss": peak_rss(),
+            },
+            pk="id",
+        )
+
+
+def peak_rss():
+    "Peak resident set size of this process in bytes, if it can be measured"
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def sync_run_history(
+    db, window=DEFAULT_HISTORY_WINDOW, slow_factor=DEFAULT_SLOW_FACTOR
+):
+    """
+    All recorded runs, oldest first, each with the median duration of the
+    previous completed runs of the same mode and whether it was slow
+    """
+    runs = []
+    previous = {}
+    for run in db.query("select * from sync_runs order by id"):
+        run["phases"] = json.loads(run["phases"] or "{}")
+        recent = previous.setdefault(run["mode"], [])[-window:]
+        run["median_duration"] = statistics.median(recent) if recent else None
+        run["slow"] = bool(
+            run["median_duration"] and run["duration"] > slow_factor * run["median_duration"]
+        )
+        if run["status"] == "completed":
+            previous[run["mode"]].append(run["duration"])
+        runs.append(run)
+    return runs
+
+
+class Recorder:
+    """
+    Tees raw extraction output to a gzip-compressed recording file.
+
+    The file starts with a header line carrying a random marker. Each stream
+    of output (folders or notes) begins with a line holding that marker, the
+    stream kind and, for notes, the split token needed to parse it again.
+    """
+
+    def __init__(self, path):
+        self.marker = secrets.token_hex(8)
+        self.fp = gzip.open(path, "wb")
+        self.fp.write(
+            f"{RECORDING_HEADER} {RECORDING_VERSION} {self.marker}\n".encode("utf8")
+        )
+
+    def start_stream(self, kind, split=None):
+        header = f"{self.marker} {kind}"
+        if split:
+            header += f" {split}"
+        self.fp.write(header.encode("utf8") + b"\n")
+
+    def tee(self, kind, lines, split=None):
+        self.start_stream(kind, split)
+        for line in lines:
+            if not line.endswith(b"\n"):
+                line += b"\n"
+            self.fp.write(line)
+            yield line
+
+    def write_folders_json(self, folders):
+        self.start_stream("folders-json")
+        for folder in folders:
+            self.fp.write(json.dumps(folder).encode("utf8") + b"\n")
+
+    def close(self):
+        self.fp.close()
+
+
+def iter_recording(path, kinds):
+    "Yield (kind, split, line) for every line in streams of the given kinds"
+    with gzip.open(path, "rb") as fp:
+        header = fp.readline().decode("utf8").split()
+        if len(header) != 3 or header[0] != RECORDING_HEADER:
+            raise click.ClickException(f"{path} is not a recording")
+        if header[1] != RECORDING_VERSION:
+            raise click.ClickException(
+                f"Unsupported recording version {header[1]} in {path}"
+            )
+        marker = (header[2] + " ").encode("utf8")
+        kind = split = None
+        for line in fp:
+            if line.startswith(marker):
+                parts = line[len(marker) :].decode("utf8").split()
+                kind = parts[0]
+                split = parts[1] if len(parts) > 1 else None
+                continue
+            if kind in kinds:
+                yield kind, split, line
+
+
+def replay_folders(path):
+    folders = []
+    raw_lines = []
+    for kind, _, line in iter_recording(path, ("folders", "folders-json")):
+        if kind == "folders-json":
+            folders.append(json.loads(line))
+        else:
+            raw_lines.append(line)
+    return folders + parse_folders(raw_lines)
+
+
+def replay_notes(path):
+    # Each recorded notes stream has its own split token
+    current_split = None
+    buffered = []
+    for _, split, line in iter_recording(path, ("notes",)):
+        if split != current_split:
+            yield from parse_notes(buffered, current_split)
+            current_split = split
+            buffered = []
+        buffered.append(line)
+        if line.strip() == f"{split}{split}".encode("utf8"):
+            yield from parse_notes(buffered, split)
+            buffered = []
+    if buffered:
+        yield from parse_notes(buffered, current_split)
+
+
+def extract_notes(since=None, recorder=None):
     split = secrets.token_hex(8)
-    folder_ids_literal = ", ".join(
-        f'"{folder_id}"' for folder_id in folder_coredata_ids
-    )
     if since:
         since = since.replace("T", " ")
-        script = FOLDER_EXTRACT_SCRIPT_SINCE.format(
-            split=split, folder_ids=folder_ids_literal, since=since
-        )
+        script = EXTRACT_SCRIPT_SINCE.format(split=split, since=since)
     else:
-        script = FOLDER_EXTRACT_SCRIPT.format(
-            split=split, folder_ids=folder_ids_literal
-        )
+        script = EXTRACT_SCRIPT.format(split=split)
     process = subprocess.Popen(
         ["osascript", "-e", script],
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
     )
+    lines = iter_process_lines(process)
+    if recorder is not None:
+        lines = recorder.tee("notes", lines, split=split)
+    yield from parse_notes(lines, split)
+
+
+def parse_notes(lines, split):
     note = {}
     body = []
-    for line in iter_process_lines(process):
+    for line in lines:
         line = line.decode("mac_roman").strip()
         if line == f"{split}{split}":
             if note.get("id"):
@@ -593,21 +2756,159 @@ def extract_notes_for_folders(folder_coredata_ids, since=None):
             body.append(line)
 
 
-def extract_folders():
-    if should_use_notestore():
-        return extract_folders_from_notestore(DEFAULT_NOTESTORE_PATH)
-    return extract_folders_from_osascript()
+def get_coredata_base():
+    coredata_id = (
+        subprocess.check_output(
+            ["osascript", "-e", 'tell application "Notes" to get id of folder 1'],
+            stderr=subprocess.STDOUT,
+        )
+        .decode("utf8")
+        .strip()
+    )
+    match = re.match(r"(x-coredata://[^/]+)/", coredata_id)
+    if not match:
+        raise click.ClickException("Could not determine coredata store identifier")
+    return match.group(1)
+
+
+def extract_notes_for_folders(folder_coredata_ids, since=None, recorder=None):
+    if not folder_coredata_ids:
+        return
+    split = secrets.token_hex(8)
+    folder_ids_literal = ", ".join(
+        f'"{folder_id}"' for folder_id in folder_coredata_ids
+    )
+    if since:
+        since = since.replace("T", " ")
+        script = FOLDER_EXTRACT_SCRIPT_SINCE.format(
+            split=split, folder_ids=folder_ids_literal, since=since
+        )
+    else:
+        script = FOLDER_EXTRACT_SCRIPT.format(
+            split=split, folder_ids=folder_ids_literal
+        )
+    process = subprocess.Popen(
+        ["osascript", "-e", script],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    lines = iter_process_lines(process)
+    if recorder is not None:
+        lines = recorder.tee("notes", lines, split=split)
+    yield from parse_notes(lines, split)
+
+
+def extract_notes_by_ids(
+    note_coredata_ids, batch_size=NOTE_ID_BATCH_SIZE, recorder=None
+):
+    "Fetch just the listed notes, one osascript run per batch of IDs"
+    note_coredata_ids = list(note_coredata_ids)
+    for start in range(0, len(note_coredata_ids), batch_size):
+        batch = note_coredata_ids[start : start + batch_size]
+        split = secrets.token_hex(8)
+        note_ids_literal = ", ".join(f'"{note_id}"' for note_id in batch)
+        script = NOTES_BY_ID_SCRIPT.format(split=split, note_ids=note_ids_literal)
+        process = subprocess.Popen(
+            ["osascript", "-e", script],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        lines = iter_process_lines(process)
+        if recorder is not None:
+            lines = recorder.tee("notes", lines, split=split)
+        yield from parse_notes(lines, split)
+
+
+def extract_note_metadata(recorder=None):
+    "Yield every note without its body"
+    split = secrets.token_hex(8)
+    process = subprocess.Popen(
+        ["osascript", "-e", METADATA_SCRIPT.format(split=split)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    lines = iter_process_lines(process)
+    if recorder is not None:
+        lines = recorder.tee("metadata", lines, split=split)
+    for note in parse_notes(lines, split):
+        note.pop("body", None)
+        yield note
+
+
+def note_metadata_from_notestore(notestore):
+    "Yield id, updated and folder for every note, read directly from NoteStore"
+    rows = notestore.execute(
+        "SELECT Z_PK, ZFOLDER, ZMODIFICATIONDATE1 FROM ZICCLOUDSYNCINGOBJECT "
+        f"WHERE Z_ENT = ? AND {notestore.not_deleted()}",
+        (notestore.entity("ICNote"),),
+    ).fetchall()
+    base = notestore.coredata_base
+    for pk, folder_pk, modified in rows:
+        yield {
+            "id": f"{base}/ICNote/p{pk}",
+            "updated": iso_timestamp(modified),
+            "folder": f"{base}/ICFolder/p{folder_pk}" if folder_pk else None,
+        }
+
+
+def iso_timestamp(timestamp):
+    # Matches AppleScript's «class isot»: local time, whole seconds
+    if timestamp is None:
+        return None
+    dt = datetime.datetime.fromtimestamp(int(timestamp) + COREDATA_EPOCH_OFFSET)
+    return dt.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def coredata_timestamp(iso_timestamp):
+    # Timestamps from AppleScript's «class isot» are in local time
+    dt = datetime.datetime.fromisoformat(iso_timestamp)
+    return dt.timestamp() - COREDATA_EPOCH_OFFSET
 
 
-def extract_folders_from_osascript():
+def changed_note_ids_from_notestore(notestore, since, folder_pks=None):
+    """
+    Return the Z_PK of every note modified after the ISO timestamp since,
+    optionally restricted to notes in the folders with these Z_PKs
+    """
+    sql = (
+        "SELECT Z_PK FROM ZICCLOUDSYNCINGOBJECT "
+        # Whole seconds, like last_sync and AppleScript's modification date
+        "WHERE Z_ENT = ? AND CAST(ZMODIFICATIONDATE1 AS INTEGER) > ? "
+        f"AND {notestore.not_deleted()}"
+    )
+    params = [notestore.entity("ICNote"), coredata_timestamp(since)]
+    if folder_pks:
+        sql += " AND ZFOLDER IN ({})".format(",".join("?" for _ in folder_pks))
+        params.extend(folder_pks)
+    return [row[0] for row in notestore.execute(sql + " ORDER BY Z_PK", params)]
+
+
+def extract_folders(recorder=None, notestore=None):
+    if notestore is not None:
+        folders = extract_folders_from_notestore(notestore)
+        if recorder is not None:
+            # No raw osascript output to keep, so record the parsed rows
+            recorder.write_folders_json(folders)
+        return folders
+    return extract_folders_from_osascript(recorder=recorder)
+
+
+def extract_folders_from_osascript(recorder=None):
     process = subprocess.Popen(
         ["osascript", "-e", FOLDERS_SCRIPT],
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
     )
+    lines = iter_process_lines(process)
+    if recorder is not None:
+        lines = recorder.tee("folders", lines)
+    return parse_folders(lines)
+
+
+def parse_folders(lines):
     folders = []
     folder = {}
-    for line in iter_process_lines(process):
+    for line in lines:
         for key in ("long_id", "name", "parent"):
             if line.startswith(f"{key}: ".encode("utf8")):
                 folder[key] = line[len(f"{key}: ") :].decode("macroman").strip() or None
@@ -618,16 +2919,8 @@ def extract_folders_from_osascript():
     return folders
 
 
-def extract_folders_from_notestore(db_path):
-    con = sqlite3.connect(str(db_path))
-    con.row_factory = sqlite3.Row
-    row = con.execute(
-        "SELECT Z_ENT FROM Z_PRIMARYKEY WHERE Z_NAME='ICFolder'"
-    ).fetchone()
-    if not row:
-        raise click.ClickException("Could not find ICFolder entity in NoteStore.sqlite")
-    folder_ent = row["Z_ENT"]
-    rows = con.execute(
+def extract_folders_from_notestore(notestore):
+    rows = notestore.execute(
         """
         SELECT
             f.Z_PK AS pk,
@@ -637,10 +2930,9 @@ def extract_folders_from_notestore(db_path):
         LEFT JOIN ZICCLOUDSYNCINGOBJECT p ON f.ZPARENT = p.Z_PK
         WHERE f.Z_ENT = ?
         """,
-        (folder_ent,),
+        (notestore.entity("ICFolder"),),
     ).fetchall()
-    con.close()
-    base = get_coredata_base()
+    base = notestore.coredata_base
     return [
         {
             "pk": row["pk"],
@@ -654,82 +2946,165 @@ def extract_folders_from_notestore(db_path):
     ]
 
 
-def topological_sort(nodes):
-    nodes = list(nodes)
-    children = {}
-    nodes_by_long_id = {}
-    for node in nodes:
-        long_id = node.get("long_id")
-        if long_id is not None:
-            nodes_by_long_id[long_id] = node
-        parent_id = node.get("parent")
-        if parent_id is not None:
-            children.setdefault(parent_id, []).append(node)
-
-    visited = set()
-
-    def traverse(node, result):
-        long_id = node.get("long_id")
-        if long_id in visited:
-            return
-        visited.add(long_id)
-        result.append(node)
-        if long_id in children:
-            for child in children[long_id]:
-                traverse(child, result)
+class FolderTree:
+    """
+    Index over a list of folder dictionaries, built once per run.
+
+    Folders are identified by their long_id and point at their parent's
+    long_id. Lookups by long_id, name and path are dictionary lookups and
+    every traversal is iterative, so deep or cyclic hierarchies are safe.
+    """
+
+    def __init__(self, folders, key="long_id"):
+        self.folders = list(folders)
+        self.key = key
+        self.by_id = {}
+        self.parents = {}
+        self.children = {}
+        self.by_name = {}
+        for folder in self.folders:
+            folder_id = folder.get(key)
+            if folder_id is None:
+                continue
+            self.by_id[folder_id] = folder
+            self.parents[folder_id] = folder.get("parent")
+            if folder.get("name"):
+                self.by_name.setdefault(folder["name"], []).append(folder)
+        for folder in self.folders:
+            parent_id = folder.get("parent")
+            if parent_id is not None:
+                self.children.setdefault(parent_id, []).append(folder.get(key))
+        self._paths = None
+        self._by_path = None
+        self._subtrees = {}
+
+    def ancestors(self, folder_id):
+        "IDs of the ancestors of this folder, nearest first"
+        ancestors = []
+        seen = {folder_id}
+        parent_id = self.parents.get(folder_id)
+        while parent_id is not None and parent_id not in seen:
+            ancestors.append(parent_id)
+            seen.add(parent_id)
+            parent_id = self.parents.get(parent_id)
+        return ancestors
+
+    @property
+    def paths(self):
+        "Map of folder ID to its slash-separated path of folder names"
+        if self._paths is None:
+            paths = {}
+            # Parents come first, so most paths extend their parent's path
+            for folder in self.topological_order():
+                folder_id = folder.get(self.key)
+                if not folder.get("name") or folder_id in paths:
+                    continue
+                parent_id = self.parents.get(folder_id)
+                if parent_id in paths:
+                    paths[folder_id] = paths[parent_id] + "/" + folder["name"]
+                    continue
+                parts = [folder["name"]]
+                for ancestor_id in self.ancestors(folder_id):
+                    ancestor = self.by_id.get(ancestor_id)
+                    if not ancestor or not ancestor.get("name"):
+                        break
+                    parts.append(ancestor["name"])
+                paths[folder_id] = "/".join(reversed(parts))
+            self._paths = paths
+        return self._paths
+
+    @property
+    def by_path(self):
+        if self._by_path is None:
+            by_path = {}
+            for folder_id, path in self.paths.items():
+                by_path.setdefault(path, []).append(self.by_id[folder_id])
+            self._by_path = by_path
+        return self._by_path
+
+    def subtree(self, folder_id):
+        "Set of IDs for this folder and all of its descendants"
+        if folder_id not in self._subtrees:
+            subtree = set()
+            stack = [folder_id]
+            while stack:
+                current = stack.pop()
+                if current in subtree:
+                    continue
+                subtree.add(current)
+                stack.extend(self.children.get(current, []))
+            self._subtrees[folder_id] = frozenset(subtree)
+        return self._subtrees[folder_id]
+
+    def closure(self):
+        "Yield (ancestor, descendant, depth) for every folder, including itself"
+        for folder_id in self.by_id:
+            yield folder_id, folder_id, 0
+            for depth, ancestor_id in enumerate(self.ancestors(folder_id), 1):
+                if ancestor_id in self.by_id:
+                    yield ancestor_id, folder_id, depth
 
-    sorted_data = []
-    for node in nodes:
-        parent_id = node.get("parent")
-        if parent_id is None or parent_id not in nodes_by_long_id:
-            traverse(node, sorted_data)
+    def topological_order(self):
+        "Folders ordered so that each parent comes before its children"
+        visited = set()
+        ordered = []
 
-    for node in nodes:
-        if node.get("long_id") not in visited:
-            traverse(node, sorted_data)
+        def visit(folder):
+            stack = [folder]
+            while stack:
+                node = stack.pop()
+                node_id = node.get(self.key)
+                if node_id in visited:
+                    continue
+                visited.add(node_id)
+                ordered.append(node)
+                stack.extend(
+                    self.by_id[child_id]
+                    for child_id in reversed(self.children.get(node_id, []))
+                    if child_id in self.by_id
+                )
+
+        for folder in self.folders:
+            parent_id = folder.get("parent")
+            if parent_id is None or parent_id not in self.by_id:
+                visit(folder)
+        # Anything left over is part of a cycle
+        for folder in self.folders:
+            if folder.get(self.key) not in visited:
+                visit(folder)
+        return ordered
 
-    return sorted_data
+
+def topological_sort(nodes):
+    return FolderTree(nodes).topological_order()
 
 
 def resolve_folder_filter(folder_filter, folders):
-    folder_paths = build_folder_paths(folders)
-    nodes_by_long_id = {
-        folder.get("long_id"): folder for folder in folders if folder.get("long_id")
-    }
-    exact_long_id_matches = [
-        folder for folder in folders if folder.get("long_id") == folder_filter
-    ]
-    if exact_long_id_matches:
-        target = exact_long_id_matches[0]
+    tree = folders if isinstance(folders, FolderTree) else FolderTree(folders)
+    if folder_filter in tree.by_id:
+        target = tree.by_id[folder_filter]
     elif "/" in folder_filter:
         path = [part for part in folder_filter.split("/") if part]
         if not path:
             raise click.UsageError("Folder path cannot be empty.")
-        parents_by_id = {
-            folder.get("long_id"): folder.get("parent") for folder in folders
-        }
-        candidates = [folder for folder in folders if folder.get("name") == path[-1]]
-        matches = []
-        for candidate in candidates:
-            current = candidate
-            ok = True
-            for part in reversed(path[:-1]):
-                parent_id = parents_by_id.get(current.get("long_id"))
-                if not parent_id:
-                    ok = False
-                    break
-                parent = nodes_by_long_id.get(parent_id)
-                if not parent or parent.get("name") != part:
-                    ok = False
-                    break
-                current = parent
-            if ok:
-                matches.append(candidate)
+        matches = tree.by_path.get("/".join(path))
+        if not matches:
+            # Fall back to matching the trailing components of a path
+            matches = []
+            for candidate in tree.by_name.get(path[-1], []):
+                ancestors = tree.ancestors(candidate.get("long_id"))
+                names = [
+                    tree.by_id[ancestor_id].get("name")
+                    for ancestor_id in ancestors[: len(path) - 1]
+                    if ancestor_id in tree.by_id
+                ]
+                if names == list(reversed(path[:-1])):
+                    matches.append(candidate)
         if not matches:
             raise click.UsageError(
                 f'No folder found matching path "{folder_filter}".\n'
                 "Available folder paths:\n"
-                + "\n".join(folder_paths)
+                + "\n".join(sorted(set(tree.paths.values())))
             )
         if len(matches) > 1:
             match_lines = []
@@ -744,11 +3119,9 @@ def resolve_folder_filter(folder_filter, folders):
             )
         target = matches[0]
     else:
-        name_matches = [folder for folder in folders if folder.get("name") == folder_filter]
+        name_matches = tree.by_name.get(folder_filter, [])
         if not name_matches:
-            available_names = sorted(
-                {folder.get("name") for folder in folders if folder.get("name")}
-            )
+            available_names = sorted(tree.by_name)
             raise click.UsageError(
                 f'No folder found matching "{folder_filter}". '
                 "Use the folder name, path, or long_id.\n"
@@ -769,62 +3142,114 @@ def resolve_folder_filter(folder_filter, folders):
         target = name_matches[0]
 
     target_long_id = target.get("long_id")
-    children = {}
-    parents_by_id = {}
-    for folder in folders:
-        parent_id = folder.get("parent")
-        parents_by_id[folder.get("long_id")] = parent_id
-        if parent_id is not None:
-            children.setdefault(parent_id, []).append(folder.get("long_id"))
+    note_folders = set(tree.subtree(target_long_id))
+    allowed = note_folders | set(tree.ancestors(target_long_id))
+    return target_long_id, note_folders, allowed
+
 
+def resolve_folder_filters(folder_filters, folders):
+    """
+    Resolve several --folder values, each a name, path, long_id or glob
+    pattern, to the union of (note folder long_ids, folder long_ids to store)
+    """
+    tree = folders if isinstance(folders, FolderTree) else FolderTree(folders)
+    note_folders = set()
     allowed = set()
-    queue = [target_long_id]
-    while queue:
-        current = queue.pop(0)
-        if current in allowed:
-            continue
-        allowed.add(current)
-        for child in children.get(current, []):
-            queue.append(child)
-
-    note_folders = set(allowed)
-    ancestor = parents_by_id.get(target_long_id)
-    while ancestor:
-        if ancestor in allowed:
-            break
-        allowed.add(ancestor)
-        ancestor = parents_by_id.get(ancestor)
+    for folder_filter in folder_filters:
+        is_literal = (
+            folder_filter in tree.by_id
+            or folder_filter in tree.by_name
+            or folder_filter in tree.by_path
+        )
+        if not is_literal and any(char in folder_filter for char in "*?["):
+            # Patterns containing a slash match full paths, others match names
+            if "/" in folder_filter:
+                candidates = tree.paths.items()
+            else:
+                candidates = (
+                    (folder_id, folder.get("name"))
+                    for folder_id, folder in tree.by_id.items()
+                )
+            target_long_ids = [
+                folder_id
+                for folder_id, value in candidates
+                if value and fnmatch.fnmatchcase(value, folder_filter)
+            ]
+            if not target_long_ids:
+                raise click.UsageError(
+                    f'No folders found matching pattern "{folder_filter}".\n'
+                    "Available folder paths:\n"
+                    + "\n".join(sorted(set(tree.paths.values())))
+                )
+        else:
+            target_long_ids = [resolve_folder_filter(folder_filter, tree)[0]]
+        for target_long_id in target_long_ids:
+            note_folders.update(tree.subtree(target_long_id))
+            allowed.update(tree.subtree(target_long_id))
+            allowed.update(tree.ancestors(target_long_id))
+    return note_folders, allowed
+
+
+def folder_pks_for(tree, folder_long_ids):
+    "NoteStore Z_PKs for these folders, or None if the folders lack them"
+    pks = [
+        tree.by_id[folder_id]["pk"]
+        for folder_id in folder_long_ids
+        if folder_id in tree.by_id and tree.by_id[folder_id].get("pk") is not None
+    ]
+    return sorted(pks) or None
 
-    return target_long_id, note_folders, allowed
+
+def folder_coredata_ids_for(tree, folder_pks):
+    # Folders read from NoteStore already use their coredata ID as long_id
+    folder_pks = set(folder_pks)
+    return [
+        folder_id
+        for folder_id, folder in tree.by_id.items()
+        if folder.get("pk") in folder_pks
+    ]
 
 
 def build_folder_paths(folders):
-    nodes_by_long_id = {
-        folder.get("long_id"): folder for folder in folders if folder.get("long_id")
-    }
-    parents_by_id = {
-        folder.get("long_id"): folder.get("parent")
-        for folder in folders
-        if folder.get("long_id")
-    }
-    paths = []
-    for folder in folders:
-        long_id = folder.get("long_id")
-        name = folder.get("name")
-        if not long_id or not name:
-            continue
-        parts = [name]
-        seen = {long_id}
-        parent_id = parents_by_id.get(long_id)
-        while parent_id:
-            if parent_id in seen:
-                break
-            seen.add(parent_id)
-            parent = nodes_by_long_id.get(parent_id)
-            if not parent or not parent.get("name"):
-                break
-            parts.append(parent["name"])
-            parent_id = parents_by_id.get(parent_id)
-        path = "/".join(reversed(parts))
-        paths.append(path)
-    return sorted(set(paths))
+    tree = folders if isinstance(folders, FolderTree) else FolderTree(folders)
+    return sorted(set(tree.paths.values()))
+
+
+def update_folder_hierarchy(db):
+    """
+    Refresh the materialized folders.path column and the folder_closure
+    table from the current contents of the folders table, returning the
+    (ancestor, descendant) pairs that were removed and added
+    """
+    tree = FolderTree(
+        db.query("select id, name, parent from folders"), key="id"
+    )
+    with transaction(db):
+        for folder_id in tree.by_id:
+            path = tree.paths.get(folder_id)
+            db.execute(
+                "update folders set path = ? where id = ? and path is not ?",
+                (path, folder_id, path),
+            )
+        existing = {
+            (row[0], row[1]): row[2]
+            for row in db.execute(
+                "select ancestor, descendant, depth from folder_closure"
+            )
+        }
+        closure = {
+            (ancestor, descendant): depth
+            for ancestor, descendant, depth in tree.closure()
+        }
+        removed = [pair for pair in existing if existing[pair] != closure.get(pair)]
+        added = [pair for pair in closure if closure[pair] != existing.get(pair)]
+        db.conn.executemany(
+            "delete from folder_closure where ancestor = ? and descendant = ?",
+            removed,
+        )
+        db.conn.executemany(
+            "insert or replace into folder_closure (ancestor, descendant, depth) "
+            "values (?, ?, ?)",
+            ((ancestor, descendant, closure[ancestor, descendant]) for ancestor, descendant in added),
+        )
+    return removed, added
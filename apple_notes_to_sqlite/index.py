@@ -0,0 +1,199 @@
+import functools
+import sqlite3
+from pathlib import Path
+
+DEFAULT_CACHE_SIZE = 1024
+
+NOTE_SQL = """
+select notes.*, folders.path as folder_path
+from notes left join folders on folders.id = notes.folder
+where notes.id = ?
+"""
+SUMMARY_COLUMNS = """
+notes.id, notes.title, notes.created, notes.updated, notes.folder,
+folders.path as folder_path
+"""
+FOLDER_NOTES_SQL = f"""
+select {SUMMARY_COLUMNS}
+from notes left join folders on folders.id = notes.folder
+where notes.folder = ?
+order by notes.updated desc
+"""
+SUBTREE_NOTES_SQL = f"""
+select {SUMMARY_COLUMNS}
+from folder_closure
+join notes on notes.folder = folder_closure.descendant
+left join folders on folders.id = notes.folder
+where folder_closure.ancestor = ?
+order by notes.updated desc
+"""
+RECENT_SQL = f"""
+select {SUMMARY_COLUMNS}
+from notes left join folders on folders.id = notes.folder
+where notes.updated > ?
+order by notes.updated desc
+limit ?
+"""
+SEARCH_SQL = f"""
+select {SUMMARY_COLUMNS}
+from notes left join folders on folders.id = notes.folder
+where notes.title like :pattern escape '\\' or notes.body like :pattern escape '\\'
+order by notes.updated desc
+limit :limit
+"""
+
+
+class NotesIndex:
+    """
+    Read-only query API over a database written by apple-notes-to-sqlite,
+    for applications that keep it open for a long time.
+
+    The folder map and the most recently used notes are kept in memory. The
+    watermark row in sync_state is bumped by triggers on every change to
+    notes or folders, and the caches are dropped whenever it moves. It is
+    only read after SQLite reports that another connection has committed,
+    so repeated reads of an unchanged database never leave memory.
+
+    Listing methods return notes without their body, use get() for that.
+    An index must not be shared between threads.
+    """
+
+    def __init__(self, db_path, cache_size=DEFAULT_CACHE_SIZE):
+        # The queries are fixed strings, so sqlite3's statement cache keeps
+        # them prepared between calls
+        self.conn = sqlite3.connect(
+            Path(db_path).resolve().as_uri() + "?mode=ro", uri=True
+        )
+        self.conn.row_factory = sqlite3.Row
+        self._data_version = None
+        self._watermark = None
+        self._folders = None
+        self._folders_by_path = None
+        self._folders_by_long_id = None
+        self._note = functools.lru_cache(maxsize=cache_size)(self._fetch_note)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    @property
+    def watermark(self):
+        self._check()
+        return self._watermark
+
+    def _check(self):
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._data_version:
+            return
+        self._data_version = data_version
+        try:
+            row = self.conn.execute(
+                "select value from sync_state where key = 'watermark'"
+            ).fetchone()
+        except sqlite3.OperationalError:
+            row = None
+        # Without a watermark, any commit by another connection counts
+        watermark = row[0] if row else ("data_version", data_version)
+        if watermark != self._watermark:
+            self._watermark = watermark
+            self._folders = None
+            self._folders_by_path = None
+            self._folders_by_long_id = None
+            self._note.cache_clear()
+
+    def _fetch_note(self, note_id):
+        row = self.conn.execute(NOTE_SQL, (note_id,)).fetchone()
+        return dict(row) if row else None
+
+    def cache_info(self):
+        return self._note.cache_info()
+
+    def get(self, note_id):
+        "The note with this ID, including its body, or None"
+        self._check()
+        note = self._note(note_id)
+        # A copy, so that callers cannot modify the cached note
+        return dict(note) if note else None
+
+    def _load_folders(self):
+        self._check()
+        if self._folders is None:
+            self._folders = {
+                row["id"]: dict(row)
+                for row in self.conn.execute("select * from folders order by id")
+            }
+            self._folders_by_path = {}
+            self._folders_by_long_id = {}
+            for folder in self._folders.values():
+                # Paths are not unique, e.g. "Notes" in every account
+                self._folders_by_path.setdefault(folder["path"], []).append(folder)
+                self._folders_by_long_id[folder["long_id"]] = folder
+
+    @property
+    def folders(self):
+        "Every folder, keyed by ID"
+        self._load_folders()
+        return self._folders
+
+    def folders_by_path(self, path):
+        "Every folder with this path, e.g. 'Work/Projects'"
+        self._load_folders()
+        return list(self._folders_by_path.get(path, []))
+
+    def folder_by_path(self, path):
+        """
+        The folder with this path, or None. Raises ValueError if several
+        folders share the path - look those up by ID or long_id instead.
+        """
+        folders = self.folders_by_path(path)
+        if len(folders) > 1:
+            raise ValueError(
+                "Multiple folders have the path {!r}: {}".format(
+                    path, ", ".join(folder["long_id"] for folder in folders)
+                )
+            )
+        return folders[0] if folders else None
+
+    def folder_by_long_id(self, long_id):
+        self._load_folders()
+        return self._folders_by_long_id.get(long_id)
+
+    def notes_in_folder(self, folder, subtree=False):
+        """
+        Notes in a folder, newest first. folder is an ID, a long_id or a
+        path such as 'Work/Projects'. With subtree=True notes in folders
+        below it are included.
+        """
+        if isinstance(folder, int):
+            found = self.folders.get(folder)
+        else:
+            found = self.folder_by_long_id(folder) or self.folder_by_path(folder)
+        if found is None:
+            raise KeyError(folder)
+        sql = SUBTREE_NOTES_SQL if subtree else FOLDER_NOTES_SQL
+        return [dict(row) for row in self.conn.execute(sql, (found["id"],))]
+
+    def recent(self, limit=20, since=""):
+        "The most recently modified notes, optionally only those after since"
+        self._check()
+        return [
+            dict(row) for row in self.conn.execute(RECENT_SQL, (since or "", limit))
+        ]
+
+    def search(self, text, limit=20):
+        "Notes with this text in their title or body, newest first"
+        self._check()
+        escaped = (
+            text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        )
+        return [
+            dict(row)
+            for row in self.conn.execute(
+                SEARCH_SQL, {"pattern": f"%{escaped}%", "limit": limit}
+            )
+        ]
@@ -1,6 +1,37 @@
 from click.testing import CliRunner
-from apple_notes_to_sqlite.cli import cli, COUNT_SCRIPT, FOLDERS_SCRIPT, topological_sort
+import click
+import gzip
+from apple_notes_to_sqlite.cli import (
+    cli,
+    COUNT_SCRIPT,
+    FOLDERS_SCRIPT,
+    MIGRATIONS,
+    FolderTree,
+    NoteStoreSnapshot,
+    build_merkle_tree,
+    changed_note_ids_from_notestore,
+    coredata_timestamp,
+    count_notes_for_folders,
+    diff_merkle_trees,
+    ensure_schema,
+    extract_hashtags,
+    find_duplicate_clusters,
+    migrate,
+    note_metadata_from_notestore,
+    minhash_signature,
+    minhash_similarity,
+    read_changes,
+    rebuild_folder_stats,
+    refresh_minhashes,
+    resolve_folder_filter,
+    resolve_folder_filters,
+    topological_sort,
+    write_folders,
+    write_note,
+)
+from apple_notes_to_sqlite import NotesIndex
 import sqlite_utils
+import sqlite3
 import json
 import os
 from unittest.mock import patch
@@ -61,6 +92,8 @@ EXPECTED_NOTES = [
         "folder": 1,
         "title": "Title 1",
         "body": "This is the content of note 1 #Alpha #beta",
+        "source": None,
+        "body_status": "complete",
     },
     {
         "id": "note-2",
@@ -69,10 +102,20 @@ EXPECTED_NOTES = [
         "folder": 2,
         "title": "Title 2",
         "body": "This is the content of note 2 #beta #Gamma",
+        "source": None,
+        "body_status": "complete",
     },
 ]
 EXPECTED_DUMP_NOTES = [
-    dict(note, folder=f"folder-{note['folder']}") for note in EXPECTED_NOTES
+    {
+        **{
+            key: value
+            for key, value in note.items()
+            if key not in ("source", "body_status")
+        },
+        "folder": f"folder-{note['folder']}",
+    }
+    for note in EXPECTED_NOTES
 ]
 EXPECTED_DUMP_NOTES_FOLDER_2 = [
     dict(EXPECTED_DUMP_NOTES[1])
@@ -97,7 +140,16 @@ def test_apple_notes_to_sqlite(mock_token_hex, fp):
         assert os.path.exists("notes.db")
         db = sqlite_utils.Database("notes.db")
         # Check tables were created
-        assert set(db.table_names()) == {"notes", "folders", "sync_state"}
+        assert set(db.table_names()) == {
+            "notes",
+            "folders",
+            "folder_closure",
+            "sync_state",
+            "tags",
+            "note_tags",
+            "folder_stats",
+            "sync_runs",
+        }
         # Check that the notes were inserted
         assert list(db["notes"].rows) == EXPECTED_NOTES
         assert db["sync_state"].get("last_sync")["value"] == "2023-03-08T15:36:41"
@@ -163,15 +215,39 @@ def test_folders(mock_token_hex, fp):
         columns = [
             row[1] for row in db.conn.execute("PRAGMA table_info(folders)")
         ]
-        assert columns == ["id", "long_id", "name", "parent"]
+        assert columns == ["id", "long_id", "name", "parent", "path", "source"]
         foreign_keys = list(db.conn.execute("PRAGMA foreign_key_list(folders)"))
         assert any(
             fk[2] == "folders" and fk[3] == "parent" and fk[4] == "id"
             for fk in foreign_keys
         )
         assert list(db["folders"].rows) == [
-            {"id": 1, "long_id": "folder-1", "name": "Folder 1", "parent": None},
-            {"id": 2, "long_id": "folder-2", "name": "Folder 2", "parent": 1},
+            {
+                "id": 1,
+                "long_id": "folder-1",
+                "name": "Folder 1",
+                "parent": None,
+                "path": "Folder 1",
+                "source": None,
+            },
+            {
+                "id": 2,
+                "long_id": "folder-2",
+                "name": "Folder 2",
+                "parent": 1,
+                "path": "Folder 1/Folder 2",
+                "source": None,
+            },
+        ]
+        assert list(
+            db.query(
+                "select ancestor, descendant, depth from folder_closure "
+                "order by descendant, depth"
+            )
+        ) == [
+            {"ancestor": 1, "descendant": 1, "depth": 0},
+            {"ancestor": 2, "descendant": 2, "depth": 0},
+            {"ancestor": 1, "descendant": 2, "depth": 1},
         ]
 
 
@@ -215,6 +291,21 @@ def test_topological_sort_includes_orphans():
     assert sorted_ids.index("a") < sorted_ids.index("b")
 
 
+def test_folder_tree_handles_deep_hierarchies():
+    # Deep enough that a recursive traversal would hit the recursion limit
+    depth = 2000
+    nodes = [
+        {"long_id": str(i), "name": f"F{i}", "parent": str(i - 1) if i else None}
+        for i in reversed(range(depth))
+    ]
+    tree = FolderTree(nodes)
+    ordered = [node["long_id"] for node in tree.topological_order()]
+    assert ordered == [str(i) for i in range(depth)]
+    assert len(tree.subtree("0")) == depth
+    assert tree.paths["2"] == "F0/F1/F2"
+    assert resolve_folder_filter("F1/F2", tree)[1] == set(map(str, range(2, depth)))
+
+
 @patch("secrets.token_hex")
 def test_recreate_alias_forces_full_scan(mock_token_hex, fp):
     fp.register_subprocess(["osascript", "-e", COUNT_SCRIPT], stdout=b"2")
@@ -227,3 +318,1003 @@ def test_recreate_alias_forces_full_scan(mock_token_hex, fp):
         assert_cli_success(result)
         db = sqlite_utils.Database("notes.db")
         assert list(db["notes"].rows) == EXPECTED_NOTES
+
+
+COREDATA_BASE_SCRIPT = 'tell application "Notes" to get id of folder 1'
+
+
+def protobuf_bytes(field, value):
+    "Encode a length-delimited protobuf field, for lengths under 128"
+    return bytes([field << 3 | 2, len(value)]) + value
+
+
+def make_notestore(path, notes, uuid=None):
+    "Create a minimal NoteStore.sqlite with two folders and the given notes"
+    con = sqlite3.connect(str(path))
+    con.executescript(
+        """
+        CREATE TABLE Z_PRIMARYKEY (Z_ENT INTEGER, Z_NAME TEXT);
+        INSERT INTO Z_PRIMARYKEY VALUES (11, 'ICFolder'), (12, 'ICNote');
+        CREATE TABLE ZICCLOUDSYNCINGOBJECT (
+            Z_PK INTEGER PRIMARY KEY, Z_ENT INTEGER, ZNAME TEXT, ZTITLE TEXT,
+            ZTITLE1 TEXT, ZTITLE2 TEXT, ZUSERTITLE TEXT, ZPARENT INTEGER,
+            ZFOLDER INTEGER, ZCREATIONDATE1 REAL, ZMODIFICATIONDATE1 REAL,
+            ZMARKEDFORDELETION INTEGER
+        );
+        CREATE TABLE ZICNOTEDATA (Z_PK INTEGER PRIMARY KEY, ZNOTE INTEGER, ZDATA BLOB);
+        INSERT INTO ZICCLOUDSYNCINGOBJECT (Z_PK, Z_ENT, ZTITLE2, ZPARENT)
+            VALUES (1, 11, 'Folder 1', NULL), (2, 11, 'Folder 2', 1);
+        """
+    )
+    if uuid:
+        con.execute("CREATE TABLE Z_METADATA (Z_VERSION INTEGER, Z_UUID TEXT)")
+        con.execute("INSERT INTO Z_METADATA VALUES (1, ?)", (uuid,))
+    for pk, folder, modified in notes:
+        con.execute(
+            "INSERT INTO ZICCLOUDSYNCINGOBJECT "
+            "(Z_PK, Z_ENT, ZTITLE1, ZFOLDER, ZCREATIONDATE1, ZMODIFICATIONDATE1) "
+            "VALUES (?, 12, ?, ?, ?, ?)",
+            (
+                pk,
+                f"Note {pk}",
+                folder,
+                coredata_timestamp("2023-01-01T00:00:00"),
+                coredata_timestamp(modified),
+            ),
+        )
+        text = f"Body of note {pk} from {modified}".encode("utf8")
+        document = protobuf_bytes(
+            2, bytes([8, 0]) + protobuf_bytes(3, protobuf_bytes(2, text))
+        )
+        con.execute(
+            "INSERT INTO ZICNOTEDATA (ZNOTE, ZDATA) VALUES (?, ?)",
+            (pk, gzip.compress(document)),
+        )
+    con.commit()
+    con.close()
+
+
+def test_changed_note_ids_from_notestore(tmp_path):
+    path = tmp_path / "NoteStore.sqlite"
+    make_notestore(
+        path,
+        [
+            (10, 1, "2023-03-01T10:00:00"),
+            (11, 2, "2023-03-09T10:00:00"),
+            (12, 1, "2023-03-10T10:00:00"),
+        ],
+    )
+    notestore = NoteStoreSnapshot(path)
+    assert changed_note_ids_from_notestore(notestore, "2023-03-08T15:36:41") == [
+        11,
+        12,
+    ]
+    assert changed_note_ids_from_notestore(
+        notestore, "2023-03-08T15:36:41", folder_pks=[2]
+    ) == [11]
+    notestore.close()
+    # last_sync is truncated to whole seconds, so a note modified part way
+    # through that second is not changed
+    path = tmp_path / "Fractional.sqlite"
+    make_notestore(path, [(10, 1, "2023-03-10T10:00:00.750")])
+    notestore = NoteStoreSnapshot(path)
+    assert changed_note_ids_from_notestore(notestore, "2023-03-10T10:00:00") == []
+    notestore.close()
+
+
+def test_notes_marked_for_deletion_are_skipped(tmp_path):
+    path = tmp_path / "NoteStore.sqlite"
+    make_notestore(
+        path,
+        [(10, 1, "2023-03-09T10:00:00"), (11, 2, "2023-03-09T10:00:00")],
+        uuid="MAC",
+    )
+    con = sqlite3.connect(str(path))
+    con.execute(
+        "UPDATE ZICCLOUDSYNCINGOBJECT SET ZMARKEDFORDELETION = 1 WHERE Z_PK = 11"
+    )
+    con.commit()
+    con.close()
+    notestore = NoteStoreSnapshot(path)
+    assert changed_note_ids_from_notestore(notestore, "2023-03-08T15:36:41") == [10]
+    assert [note["id"] for note in note_metadata_from_notestore(notestore)] == [
+        "x-coredata://MAC/ICNote/p10"
+    ]
+    notestore.close()
+
+
+@patch("secrets.token_hex")
+def test_incremental_sync_fetches_changed_ids_from_notestore(
+    mock_token_hex, fp, tmp_path, monkeypatch
+):
+    notestore = tmp_path / "NoteStore.sqlite"
+    make_notestore(
+        notestore,
+        [(10, 1, "2023-03-01T10:00:00"), (11, 2, "2023-03-09T10:00:00")],
+    )
+    monkeypatch.setenv("APPLE_NOTES_TO_SQLITE_USE_NOTESTORE", "1")
+    monkeypatch.setattr(
+        "apple_notes_to_sqlite.cli.DEFAULT_NOTESTORE_PATH", notestore
+    )
+    fp.keep_last_process(True)
+    fp.register_subprocess(
+        ["osascript", "-e", COREDATA_BASE_SCRIPT],
+        stdout=b"x-coredata://STORE/ICFolder/p1",
+    )
+    fp.register_subprocess(
+        ["osascript", "-e", fp.any()],
+        stdout=FAKE_OUTPUT.replace(b"folder-", b"x-coredata://STORE/ICFolder/p"),
+    )
+    mock_token_hex.return_value = "abcdefg"
+    db_path = str(tmp_path / "notes.db")
+    db = sqlite_utils.Database(db_path)
+    db["sync_state"].insert(
+        {"key": "last_sync", "value": "2023-03-05T00:00:00"}, pk="key"
+    )
+    result = CliRunner().invoke(cli, [db_path])
+    assert_cli_success(result)
+    scripts = [call[2] for call in fp.calls if call[2] != COREDATA_BASE_SCRIPT]
+    # Only the changed note is requested, and nothing walks every note
+    assert len(scripts) == 1
+    assert '"x-coredata://STORE/ICNote/p11"' in scripts[0]
+    assert "every note" not in scripts[0]
+
+
+@patch("secrets.token_hex")
+def test_incremental_sync_keeps_last_sync_when_changed_notes_are_missing(
+    mock_token_hex, fp, tmp_path, monkeypatch
+):
+    notestore = tmp_path / "NoteStore.sqlite"
+    make_notestore(
+        notestore,
+        [
+            (11, 1, "2023-03-09T10:00:00"),
+            (12, 1, "2023-03-08T10:00:00"),
+            (13, 1, "2023-03-07T10:00:00"),
+        ],
+        uuid="STORE",
+    )
+    monkeypatch.setenv("APPLE_NOTES_TO_SQLITE_USE_NOTESTORE", "1")
+    monkeypatch.setattr(
+        "apple_notes_to_sqlite.cli.DEFAULT_NOTESTORE_PATH", notestore
+    )
+    # p12 was deleted from Notes after the snapshot was taken
+    fp.register_subprocess(
+        ["osascript", "-e", fp.any()],
+        stdout=b"\n".join(
+            b"abcdefg-id: x-coredata://STORE/ICNote/p%d\n"
+            b"abcdefg-created: 2023-01-01T00:00:00\n"
+            b"abcdefg-updated: %s\n"
+            b"abcdefg-folder: x-coredata://STORE/ICFolder/p1\n"
+            b"abcdefg-title: Note\n\nBody\nabcdefgabcdefg" % (pk, updated)
+            for pk, updated in (
+                (11, b"2023-03-09T10:00:00"),
+                (13, b"2023-03-07T10:00:00"),
+            )
+        ),
+    )
+    mock_token_hex.return_value = "abcdefg"
+    db_path = str(tmp_path / "notes.db")
+    db = sqlite_utils.Database(db_path)
+    db["sync_state"].insert(
+        {"key": "last_sync", "value": "2023-03-05T00:00:00"}, pk="key"
+    )
+    result = CliRunner().invoke(cli, [db_path])
+    assert_cli_success(result)
+    # Each note is fetched inside its own try block
+    assert "try" in fp.calls[-1][2]
+    assert "1 changed notes could not be fetched" in result.output
+    assert [row["id"] for row in db["notes"].rows] == [
+        "x-coredata://STORE/ICNote/p11",
+        "x-coredata://STORE/ICNote/p13",
+    ]
+    assert db["sync_state"].get("last_sync")["value"] == "2023-03-05T00:00:00"
+    assert db["sync_runs"].get(1)["status"] == "partial"
+
+
+def test_migrations_upgrade_existing_database(tmp_path):
+    db_path = str(tmp_path / "notes.db")
+    # A database created before schema versioning existed
+    db = sqlite_utils.Database(db_path)
+    db["folders"].create({"id": int, "long_id": str, "name": str, "parent": int}, pk="id")
+    db["notes"].insert(dict(EXPECTED_NOTES[0]), pk="id")
+    db["sync_state"].create({"key": str, "value": str}, pk="key")
+    result = CliRunner().invoke(cli, [db_path, "--schema"])
+    assert_cli_success(result)
+    db = sqlite_utils.Database(db_path)
+    assert int(db["sync_state"].get("schema_version")["value"]) == len(MIGRATIONS)
+    index_columns = {tuple(index.columns) for index in db["notes"].indexes}
+    assert {("folder",), ("updated",)} <= index_columns
+    assert "sqlite_stat1" in db.table_names()
+    # Running again is a no-op
+    assert migrate(db) == []
+
+
+def test_failed_migration_is_rolled_back(tmp_path, monkeypatch):
+    db = sqlite_utils.Database(str(tmp_path / "notes.db"))
+    ensure_schema(db)
+    db["folders"].insert({"id": 1, "long_id": "f1", "name": "Folder"})
+    db["folder_closure"].insert({"ancestor": 1, "descendant": 1, "depth": 0})
+    db["notes"].insert(dict(EXPECTED_NOTES[0], folder=1))
+    folder_stats = list(db["folder_stats"].rows)
+    assert folder_stats
+
+    def m999_broken(db):
+        db.conn.execute("create table half_done (id integer)")
+        # Helpers that write must not commit the migration part way through
+        db.execute("delete from notes")
+        rebuild_folder_stats(db)
+        raise RuntimeError("boom")
+
+    import apple_notes_to_sqlite.cli
+
+    monkeypatch.setattr(
+        apple_notes_to_sqlite.cli, "MIGRATIONS", MIGRATIONS + [m999_broken]
+    )
+    with pytest.raises(RuntimeError):
+        migrate(db)
+    assert int(db["sync_state"].get("schema_version")["value"]) == len(MIGRATIONS)
+    assert "half_done" not in db.table_names()
+    assert db["notes"].count == 1
+    assert list(db["folder_stats"].rows) == folder_stats
+
+
+def test_resolve_folder_filters_globs_and_union():
+    tree = FolderTree(
+        [
+            {"long_id": "work", "name": "Work", "parent": None},
+            {"long_id": "work-a", "name": "A", "parent": "work"},
+            {"long_id": "work-a-x", "name": "X", "parent": "work-a"},
+            {"long_id": "work-b", "name": "B", "parent": "work"},
+            {"long_id": "home", "name": "Home", "parent": None},
+            {"long_id": "home-c", "name": "C [old]", "parent": "home"},
+        ]
+    )
+    note_folders, allowed = resolve_folder_filters(["Work/*"], tree)
+    assert note_folders == {"work-a", "work-a-x", "work-b"}
+    assert allowed == note_folders | {"work"}
+    note_folders, allowed = resolve_folder_filters(["C [old]", "Work/A", "A"], tree)
+    assert note_folders == {"home-c", "work-a", "work-a-x"}
+    assert allowed == note_folders | {"home", "work"}
+    with pytest.raises(click.UsageError):
+        resolve_folder_filters(["Nope/*"], tree)
+
+
+@patch("secrets.token_hex")
+def test_multiple_folder_filters_single_extraction(mock_token_hex, fp, tmp_path):
+    fp.register_subprocess(["osascript", "-e", FOLDERS_SCRIPT], stdout=FOLDER_OUTPUT)
+    fp.register_subprocess(["osascript", "-e", fp.any()], stdout=FAKE_OUTPUT)
+    mock_token_hex.return_value = "abcdefg"
+    db_path = str(tmp_path / "notes.db")
+    result = CliRunner().invoke(
+        cli, [db_path, "--folder", "Folder 2", "--folder", "Folder *"]
+    )
+    assert_cli_success(result)
+    assert list(sqlite_utils.Database(db_path)["notes"].rows) == EXPECTED_NOTES
+    # Folders fetched once, notes extracted in a single pass
+    assert len(fp.calls) == 2
+
+
+@patch("secrets.token_hex")
+def test_record_and_replay(mock_token_hex, fp, tmp_path):
+    fp.register_subprocess(["osascript", "-e", COUNT_SCRIPT], stdout=b"2")
+    fp.register_subprocess(["osascript", "-e", FOLDERS_SCRIPT], stdout=FOLDER_OUTPUT)
+    fp.register_subprocess(["osascript", "-e", fp.any()], stdout=FAKE_OUTPUT)
+    mock_token_hex.return_value = "abcdefg"
+    recording = str(tmp_path / "notes.recording.gz")
+    result = CliRunner().invoke(
+        cli, [str(tmp_path / "recorded.db"), "--record", recording]
+    )
+    assert_cli_success(result)
+    calls = len(fp.calls)
+    # Replay touches neither osascript nor the recorded split token
+    mock_token_hex.return_value = "zzzzzzz"
+    replayed_db = str(tmp_path / "replayed.db")
+    result = CliRunner().invoke(cli, [replayed_db, "--replay", recording])
+    assert_cli_success(result)
+    assert len(fp.calls) == calls
+    db = sqlite_utils.Database(replayed_db)
+    assert list(db["notes"].rows) == EXPECTED_NOTES
+    assert [row["path"] for row in db["folders"].rows] == [
+        "Folder 1",
+        "Folder 1/Folder 2",
+    ]
+    result = CliRunner().invoke(
+        cli, ["--dump", "--replay", recording, "--folder", "Folder 2"]
+    )
+    assert_cli_success(result)
+    notes = [
+        json.loads(line)
+        for line in result.output.splitlines()
+        if line.startswith("{")
+    ]
+    assert notes == EXPECTED_DUMP_NOTES_FOLDER_2
+
+
+def test_extract_hashtags():
+    assert extract_hashtags(
+        '<div>Plan #Work-Items and #work-items, #2023 #Q3 '
+        '<a href="https://example.com/#anchor">link</a> &#39;quoted&#39;</div>'
+        '<div style="color: #ff0000">#Home</div>'
+    ) == {"work-items": "Work-Items", "q3": "Q3", "home": "Home"}
+
+
+@patch("secrets.token_hex")
+def test_note_tags_maintained(mock_token_hex, fp, tmp_path):
+    fp.register_subprocess(["osascript", "-e", COUNT_SCRIPT], stdout=b"2")
+    fp.register_subprocess(["osascript", "-e", FOLDERS_SCRIPT], stdout=FOLDER_OUTPUT)
+    fp.register_subprocess(["osascript", "-e", fp.any()], stdout=FAKE_OUTPUT)
+    mock_token_hex.return_value = "abcdefg"
+    db_path = str(tmp_path / "notes.db")
+    assert_cli_success(CliRunner().invoke(cli, [db_path]))
+    db = sqlite_utils.Database(db_path)
+    tag_sql = (
+        "select note_id, tags.key, tags.name from note_tags "
+        "join tags on tags.id = note_tags.tag_id order by note_id, key"
+    )
+    assert [tuple(row.values()) for row in db.query(tag_sql)] == [
+        ("note-1", "alpha", "Alpha"),
+        ("note-1", "beta", "beta"),
+        ("note-2", "beta", "beta"),
+        ("note-2", "gamma", "Gamma"),
+    ]
+    # note-1 has gone from Notes
+    fp.register_subprocess(["osascript", "-e", FOLDERS_SCRIPT], stdout=FOLDER_OUTPUT)
+    fp.register_subprocess(["osascript", "-e", COUNT_SCRIPT], stdout=b"1")
+    fp.register_subprocess(
+        ["osascript", "-e", fp.any()],
+        stdout=FAKE_OUTPUT[FAKE_OUTPUT.index(b"abcdefg-id: note-2") :],
+    )
+    assert_cli_success(CliRunner().invoke(cli, [db_path, "--sync-delete-missing"]))
+    assert [tuple(row.values()) for row in db.query(tag_sql)] == [
+        ("note-2", "beta", "beta"),
+        ("note-2", "gamma", "Gamma"),
+    ]
+    assert [row["key"] for row in db["tags"].rows] == ["beta", "gamma"]
+
+
+def test_minhash_similarity():
+    text = " ".join(f"word{i}" for i in range(200))
+    near_copy = text.replace("word100 ", "changed ")
+    assert minhash_similarity(
+        minhash_signature(text), minhash_signature(near_copy)
+    ) > 0.8
+    assert minhash_similarity(
+        minhash_signature(text), minhash_signature("something else entirely")
+    ) < 0.2
+    assert minhash_signature("<div></div>") is None
+
+
+def test_duplicates(tmp_path):
+    db_path = str(tmp_path / "notes.db")
+    db = sqlite_utils.Database(db_path)
+    ensure_schema(db)
+    template = " ".join(f"agenda item {i} discuss" for i in range(60))
+    notes = {
+        "a": template,
+        "b": template + " extra",
+        "c": "<div>" + template + "</div>",
+        "d": "Shopping list: eggs, milk, bread",
+        "e": "Shopping list: eggs, milk, bread",
+        "f": "Something unrelated to anything else here",
+    }
+    for note_id, body in notes.items():
+        write_note(
+            db,
+            {"id": note_id, "title": note_id, "updated": "1", "folder": None, "body": body},
+        )
+    result = CliRunner().invoke(cli, ["duplicates", db_path])
+    assert_cli_success(result)
+    clusters = [
+        [note["id"] for note in json.loads(line)["notes"]]
+        for line in result.output.splitlines()
+        if line.startswith("{")
+    ]
+    assert clusters == [["a", "b", "c"], ["d", "e"]]
+    # Only notes whose updated value changes are recomputed
+    assert refresh_minhashes(db) == 0
+    db["notes"].update("e", {"updated": "2", "body": "Different now"})
+    assert refresh_minhashes(db) == 1
+    assert find_duplicate_clusters(db) == [["a", "b", "c"]]
+    # Deleting a note removes its signature and buckets
+    db["notes"].delete("a")
+    assert not db["note_lsh_buckets"].count_where("note_id = 'a'")
+    assert find_duplicate_clusters(db) == [["b", "c"]]
+
+
+@patch("secrets.token_hex")
+def test_folder_stats(mock_token_hex, fp, tmp_path):
+    fp.register_subprocess(["osascript", "-e", COUNT_SCRIPT], stdout=b"2")
+    fp.register_subprocess(["osascript", "-e", FOLDERS_SCRIPT], stdout=FOLDER_OUTPUT)
+    fp.register_subprocess(["osascript", "-e", fp.any()], stdout=FAKE_OUTPUT)
+    mock_token_hex.return_value = "abcdefg"
+    db_path = str(tmp_path / "notes.db")
+    assert_cli_success(CliRunner().invoke(cli, [db_path]))
+    db = sqlite_utils.Database(db_path)
+    stats_sql = "select * from folder_stats order by folder_id"
+    assert list(db.query(stats_sql)) == [
+        # Folder 1 rolls up Folder 2
+        {"folder_id": 1, "note_count": 2, "total_bytes": 84, "last_updated": "2023-03-08T15:36:41"},
+        {"folder_id": 2, "note_count": 1, "total_bytes": 42, "last_updated": "2023-03-08T15:36:41"},
+    ]
+    # note-1 deleted, note-2 edited
+    fp.register_subprocess(["osascript", "-e", FOLDERS_SCRIPT], stdout=FOLDER_OUTPUT)
+    fp.register_subprocess(["osascript", "-e", COUNT_SCRIPT], stdout=b"1")
+    fp.register_subprocess(
+        ["osascript", "-e", fp.any()],
+        stdout=FAKE_OUTPUT[FAKE_OUTPUT.index(b"abcdefg-id: note-2") :]
+        .replace(b"15:36:41", b"18:00:00")
+        .replace(b"#Gamma", b"#Gamma #Delta"),
+    )
+    assert_cli_success(CliRunner().invoke(cli, [db_path, "--sync-delete-missing"]))
+    # Folder IDs are unchanged by the second run
+    assert [row["id"] for row in db["folders"].rows] == [1, 2]
+    assert list(db.query(stats_sql)) == [
+        {"folder_id": 1, "note_count": 1, "total_bytes": 49, "last_updated": "2023-03-08T18:00:00"},
+        {"folder_id": 2, "note_count": 1, "total_bytes": 49, "last_updated": "2023-03-08T18:00:00"},
+    ]
+    # Triggers agree with a full recomputation
+    incremental = list(db.query(stats_sql))
+    rebuild_folder_stats(db)
+    assert list(db.query(stats_sql)) == incremental
+    # Moving Folder 2 to the top level recomputes the roll-ups
+    fp.register_subprocess(
+        ["osascript", "-e", FOLDERS_SCRIPT],
+        stdout=FOLDER_OUTPUT.replace(b"parent: folder-1", b"parent: "),
+    )
+    fp.register_subprocess(["osascript", "-e", COUNT_SCRIPT], stdout=b"0")
+    fp.register_subprocess(["osascript", "-e", fp.any()], stdout=b"")
+    assert_cli_success(CliRunner().invoke(cli, [db_path]))
+    assert [
+        (row["folder_id"], row["note_count"]) for row in db.query(stats_sql)
+    ] == [(1, 0), (2, 1)]
+
+
+@patch("secrets.token_hex")
+def test_changes(mock_token_hex, fp, tmp_path):
+    fp.register_subprocess(["osascript", "-e", COUNT_SCRIPT], stdout=b"2")
+    fp.register_subprocess(["osascript", "-e", FOLDERS_SCRIPT], stdout=FOLDER_OUTPUT)
+    fp.register_subprocess(["osascript", "-e", fp.any()], stdout=FAKE_OUTPUT)
+    mock_token_hex.return_value = "abcdefg"
+    db_path = str(tmp_path / "notes.db")
+    assert_cli_success(CliRunner().invoke(cli, [db_path, "--changes"]))
+    db = sqlite_utils.Database(db_path)
+    assert [
+        (change["seq"], change["table"], change["id"], change["op"])
+        for change in read_changes(db)
+    ] == [
+        (1, "folders", "1", "insert"),
+        (2, "folders", "2", "insert"),
+        (3, "folders", "1", "update"),
+        (4, "folders", "2", "update"),
+        (5, "notes", "note-1", "insert"),
+        (6, "notes", "note-2", "insert"),
+    ]
+    # A second run without --changes: note-1 deleted, note-2 unchanged
+    fp.register_subprocess(["osascript", "-e", FOLDERS_SCRIPT], stdout=FOLDER_OUTPUT)
+    fp.register_subprocess(["osascript", "-e", COUNT_SCRIPT], stdout=b"1")
+    fp.register_subprocess(
+        ["osascript", "-e", fp.any()],
+        stdout=FAKE_OUTPUT[FAKE_OUTPUT.index(b"abcdefg-id: note-2") :],
+    )
+    assert_cli_success(CliRunner().invoke(cli, [db_path, "--sync-delete-missing"]))
+    result = CliRunner().invoke(cli, ["changes", db_path, "--since", "6"])
+    assert_cli_success(result)
+    assert [json.loads(line) for line in result.output.splitlines()] == [
+        {
+            "seq": 7,
+            "table": "notes",
+            "id": "note-1",
+            "op": "delete",
+            "tombstone": {
+                "folder": 1,
+                "title": "Title 1",
+                "created": "2023-03-08T16:36:41",
+                "updated": "2023-03-08T15:36:41",
+            },
+        }
+    ]
+    latest = list(read_changes(db, latest=True))
+    assert [(change["id"], change["op"]) for change in latest] == [
+        ("1", "update"),
+        ("2", "update"),
+        ("note-2", "insert"),
+        ("note-1", "delete"),
+    ]
+    assert latest[2]["row"] == EXPECTED_NOTES[1]
+
+
+def test_diff_merkle_trees():
+    source = [
+        {"id": "a", "updated": "1", "folder": "f1"},
+        {"id": "b", "updated": "2", "folder": "f1"},
+        {"id": "c", "updated": "1", "folder": "f2"},
+    ]
+    assert diff_merkle_trees(
+        build_merkle_tree(source), build_merkle_tree(list(reversed(source)))
+    ) == (set(), set())
+    mirror = [
+        {"id": "a", "updated": "1", "folder": "f1"},
+        {"id": "b", "updated": "1", "folder": "f1"},
+        {"id": "c", "updated": "1", "folder": "f1"},
+        {"id": "d", "updated": "1", "folder": "f2"},
+    ]
+    assert diff_merkle_trees(build_merkle_tree(source), build_merkle_tree(mirror)) == (
+        {"b", "c"},
+        {"d"},
+    )
+
+
+@patch("secrets.token_hex")
+def test_verify_repairs_only_divergent_notes(mock_token_hex, fp, tmp_path):
+    fp.register_subprocess(["osascript", "-e", COUNT_SCRIPT], stdout=b"2")
+    fp.register_subprocess(["osascript", "-e", FOLDERS_SCRIPT], stdout=FOLDER_OUTPUT)
+    fp.register_subprocess(["osascript", "-e", fp.any()], stdout=FAKE_OUTPUT)
+    mock_token_hex.return_value = "abcdefg"
+    db_path = str(tmp_path / "notes.db")
+    assert_cli_success(CliRunner().invoke(cli, [db_path]))
+    db = sqlite_utils.Database(db_path)
+    # Drift: note-2 is stale in the mirror and a note that no longer exists
+    db["notes"].update("note-2", {"updated": "2000-01-01T00:00:00", "body": "old"})
+    db["notes"].insert(dict(EXPECTED_NOTES[0], id="note-gone"))
+    fp.register_subprocess(["osascript", "-e", FOLDERS_SCRIPT], stdout=FOLDER_OUTPUT)
+    metadata = b"\n".join(
+        line
+        for line in FAKE_OUTPUT.splitlines()
+        if line.startswith(b"abcdefg") or not line
+    )
+    fp.register_subprocess(["osascript", "-e", fp.any()], stdout=metadata)
+    fp.register_subprocess(
+        ["osascript", "-e", fp.any()],
+        stdout=FAKE_OUTPUT[FAKE_OUTPUT.index(b"abcdefg-id: note-2") :],
+    )
+    result = CliRunner().invoke(cli, [db_path, "--verify"])
+    assert_cli_success(result)
+    assert "1 changed, 0 missing, 1 deleted from Notes" in result.output
+    # Only the divergent note was fetched, by ID
+    assert '"note-2"' in fp.calls[-1][2]
+    assert "body" not in fp.calls[-2][2]
+    assert list(db["notes"].rows) == EXPECTED_NOTES
+
+
+def test_notestore_snapshot_is_consistent(tmp_path):
+    path = tmp_path / "Note Store.sqlite"
+    make_notestore(path, [(10, 1, "2023-03-01T10:00:00")])
+    notestore = NoteStoreSnapshot(path)
+    assert count_notes_for_folders([1, 2], notestore) == 1
+    # Writes to the live store after the snapshot was taken are not seen
+    live = sqlite3.connect(str(path))
+    live.execute(
+        "INSERT INTO ZICCLOUDSYNCINGOBJECT (Z_PK, Z_ENT, ZFOLDER) VALUES (11, 12, 2)"
+    )
+    live.commit()
+    live.close()
+    assert count_notes_for_folders([1, 2], notestore) == 1
+    assert changed_note_ids_from_notestore(notestore, "2023-01-01T00:00:00") == [10]
+    with pytest.raises(sqlite3.OperationalError):
+        notestore.execute("DELETE FROM ZICCLOUDSYNCINGOBJECT")
+    notestore.close()
+    assert count_notes_for_folders([1, 2], NoteStoreSnapshot(path)) == 2
+
+
+def test_merge(tmp_path):
+    first = tmp_path / "first" / "NoteStore.sqlite"
+    second = tmp_path / "second" / "NoteStore.sqlite"
+    backup = tmp_path / "backup" / "NoteStore.sqlite"
+    for path in (first, second, backup):
+        path.parent.mkdir()
+    make_notestore(first, [(10, 1, "2023-03-01T10:00:00")], uuid="MAC")
+    make_notestore(second, [(10, 2, "2023-03-02T10:00:00")], uuid="LAPTOP")
+    # An older copy of the first store's note
+    make_notestore(backup, [(10, 1, "2023-02-01T10:00:00")], uuid="MAC")
+    db_path = str(tmp_path / "merged.db")
+    runner = CliRunner()
+    result = runner.invoke(
+        cli, ["merge", db_path, str(first), str(second), str(backup), "--workers", "3"]
+    )
+    assert_cli_success(result)
+    db = sqlite_utils.Database(db_path)
+    notes = list(db.query("select * from notes order by id"))
+    assert [(note["id"], note["updated"], note["body"]) for note in notes] == [
+        (
+            "x-coredata://LAPTOP/ICNote/p10",
+            "2023-03-02T10:00:00",
+            "Body of note 10 from 2023-03-02T10:00:00",
+        ),
+        (
+            "x-coredata://MAC/ICNote/p10",
+            "2023-03-01T10:00:00",
+            "Body of note 10 from 2023-03-01T10:00:00",
+        ),
+    ]
+    assert notes[0]["source"] == str(second.resolve())
+    assert notes[1]["source"] == str(first.resolve())
+    folders = {row["long_id"]: row for row in db["folders"].rows}
+    assert folders["x-coredata://LAPTOP/ICFolder/p2"]["path"] == "Folder 1/Folder 2"
+    assert folders["x-coredata://MAC/ICFolder/p2"]["path"] == "Folder 1/Folder 2"
+    mac_root = folders["x-coredata://MAC/ICFolder/p1"]["id"]
+    assert db["folder_stats"].get(mac_root)["note_count"] == 1
+    # Unchanged stores are skipped on the next run
+    result = runner.invoke(cli, ["merge", db_path, str(first), str(second)])
+    assert_cli_success(result)
+    assert result.output.count("Skipping unchanged") == 2
+
+
+def test_export_files(tmp_path):
+    db_path = str(tmp_path / "notes.db")
+    db = sqlite_utils.Database(db_path)
+    ensure_schema(db)
+    db["folders"].insert_all(
+        [
+            {"id": 1, "long_id": "work", "name": "Work", "parent": None, "path": "Work"},
+            {"id": 2, "long_id": "misc", "name": "Misc", "parent": None, "path": "Misc"},
+        ],
+        pk="id",
+    )
+    for id, folder, title in (("a", 1, "Plan: Q1"), ("b", 1, "Ideas"), ("c", 2, "Misc")):
+        db["notes"].insert(
+            {
+                "id": id,
+                "created": "2023-01-01T00:00:00",
+                "updated": "2023-01-01T00:00:00",
+                "folder": folder,
+                "title": title,
+                "body": f"<div>{title} &amp; more</div>",
+            },
+            pk="id",
+        )
+    output = tmp_path / "files"
+    runner = CliRunner()
+
+    def run(*args):
+        result = runner.invoke(cli, ["export-files", db_path, str(output), *args])
+        assert_cli_success(result)
+        return result.output
+
+    def files():
+        return sorted(
+            str(path.relative_to(output)) for path in output.rglob("*") if path.is_file()
+        )
+
+    assert "Wrote 3, moved 0, removed 0, unchanged 0" in run()
+    initial = files()
+    assert [path.split(" ")[0] for path in initial] == ["Misc/Misc", "Work/Ideas", "Work/Plan-"]
+    plan = output / initial[2]
+    assert plan.read_text() == (
+        '---\nid: "a"\ntitle: "Plan: Q1"\ncreated: "2023-01-01T00:00:00"\n'
+        'updated: "2023-01-01T00:00:00"\n---\n\nPlan: Q1 & more\n'
+    )
+    assert "Wrote 0, moved 0, removed 0, unchanged 3" in run()
+
+    # Rename a folder, edit one note, delete another
+    db["folders"].update(1, {"name": "Jobs", "path": "Jobs"})
+    db["notes"].update("b", {"updated": "2023-02-01T00:00:00", "body": "New ideas"})
+    db["notes"].delete("c")
+    assert "Wrote 1, moved 1, removed 1, unchanged 0" in run()
+    assert [path.split(" ")[0] for path in files()] == ["Jobs/Ideas", "Jobs/Plan-"]
+    assert not (output / "Work").exists()
+    assert not (output / "Misc").exists()
+    assert (output / files()[0]).read_text().endswith("\n\nNew ideas\n")
+
+    run("--format", "html")
+    assert [path.rsplit(".", 1)[1] for path in files()] == ["html", "html"]
+
+
+@patch("secrets.token_hex")
+def test_sync_runs_and_history(mock_token_hex, fp):
+    fp.register_subprocess(["osascript", "-e", COUNT_SCRIPT], stdout=b"2")
+    fp.register_subprocess(["osascript", "-e", FOLDERS_SCRIPT], stdout=FOLDER_OUTPUT)
+    fp.register_subprocess(["osascript", "-e", fp.any()], stdout=FAKE_OUTPUT)
+    mock_token_hex.return_value = "abcdefg"
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        result = runner.invoke(cli, ["notes.db"])
+        assert_cli_success(result)
+        db = sqlite_utils.Database("notes.db")
+        [run] = db["sync_runs"].rows
+        assert run["mode"] == "full"
+        assert run["status"] == "completed"
+        assert (
+            run["notes_seen"],
+            run["notes_written"],
+            run["notes_skipped"],
+            run["notes_deleted"],
+        ) == (2, 2, 0, 0)
+        assert run["bytes_extracted"] == 84
+        assert set(json.loads(run["phases"])) == {"folders", "count", "notes", "write"}
+        assert run["peak_rss"] > 0
+        # Add some history: the last incremental run is three times the median
+        for duration in (2.0, 2.5, 1.5, 6.0):
+            db["sync_runs"].insert(
+                dict(run, id=None, mode="incremental", duration=duration)
+            )
+        result = runner.invoke(cli, ["history", "notes.db"])
+        assert_cli_success(result)
+        lines = [line for line in result.output.splitlines() if "incremental " in line]
+        assert [line.endswith("SLOW (median 2.0s)") for line in lines] == [
+            False,
+            False,
+            False,
+            True,
+        ]
+        result = runner.invoke(cli, ["history", "notes.db", "--json", "--limit", "1"])
+        [latest] = [json.loads(line) for line in result.output.splitlines()]
+        assert latest["slow"] is True
+        assert latest["median_duration"] == 2.0
+
+
+METADATA_OUTPUT = b"\n".join(
+    line
+    for line in FAKE_OUTPUT.replace(
+        b"abcdefg-updated: 2023-03-08T15:36:41\nabcdefg-folder: folder-2",
+        b"abcdefg-updated: 2023-03-09T10:00:00\nabcdefg-folder: folder-2",
+    ).splitlines()
+    if line.startswith(b"abcdefg") or not line
+)
+
+
+@patch("secrets.token_hex")
+def test_metadata_first(mock_token_hex, fp, tmp_path):
+    mock_token_hex.return_value = "abcdefg"
+    fp.register_subprocess(["osascript", "-e", FOLDERS_SCRIPT], stdout=FOLDER_OUTPUT)
+    fp.register_subprocess(["osascript", "-e", fp.any()], stdout=METADATA_OUTPUT)
+    fp.register_subprocess(["osascript", "-e", fp.any()], stdout=FAKE_OUTPUT)
+    db_path = str(tmp_path / "notes.db")
+    result = CliRunner().invoke(cli, [db_path, "--metadata-first"])
+    assert_cli_success(result)
+    assert "body" not in fp.calls[1][2]
+    # Bodies are fetched newest first
+    hydrate_script = fp.calls[2][2]
+    assert hydrate_script.index('"note-2"') < hydrate_script.index('"note-1"')
+    db = sqlite_utils.Database(db_path)
+    assert list(db["notes"].rows) == EXPECTED_NOTES
+    assert db["sync_state"].get("last_sync")["value"] == "2023-03-09T10:00:00"
+    assert db["sync_runs"].get(1)["mode"] == "metadata-first"
+    # A body left pending by an interrupted run
+    db["notes"].update("note-1", {"body_status": "pending"})
+    fp.register_subprocess(
+        ["osascript", "-e", fp.any()],
+        stdout=FAKE_OUTPUT[: FAKE_OUTPUT.index(b"abcdefg-id: note-2")],
+    )
+    result = CliRunner().invoke(cli, ["hydrate", db_path])
+    assert_cli_success(result)
+    assert "Fetched 1 of 1 pending note bodies" in result.output
+    assert db["notes"].get("note-1")["body_status"] == "complete"
+    # A pending note deleted from Notes before its body was fetched, which
+    # aborts the batch before note-1 is returned
+    db["notes"].update(
+        "note-1", {"body_status": "pending", "updated": "2023-03-10T10:00:00"}
+    )
+    db["notes"].update("note-2", {"body_status": "pending"})
+    fp.register_subprocess(
+        ["osascript", "-e", fp.any()], stdout=b"execution error: Can't get note id"
+    )
+    fp.register_subprocess(
+        ["osascript", "-e", fp.any()],
+        stdout=FAKE_OUTPUT[: FAKE_OUTPUT.index(b"abcdefg-id: note-2")],
+    )
+    fp.register_subprocess(["osascript", "-e", fp.any()], stdout=b"")
+    result = CliRunner().invoke(cli, ["hydrate", db_path])
+    assert_cli_success(result)
+    assert "Fetched 1 of 2 pending note bodies" in result.output
+    assert db["notes"].get("note-1")["body_status"] == "complete"
+    assert db["notes"].get("note-2")["body_status"] == "missing"
+    result = CliRunner().invoke(cli, ["hydrate", db_path])
+    assert "No pending note bodies" in result.output
+    result = CliRunner().invoke(
+        cli, [db_path, "--metadata-first", "--stop-after", "1"]
+    )
+    assert result.exit_code == 2
+    assert "--metadata-first cannot be used with" in result.output
+
+
+@patch("secrets.token_hex")
+def test_dump_fields(mock_token_hex, fp):
+    mock_token_hex.return_value = "abcdefg"
+    fp.register_subprocess(["osascript", "-e", fp.any()], stdout=METADATA_OUTPUT)
+    result = CliRunner().invoke(cli, ["--dump", "--fields", "id,updated"])
+    assert_cli_success(result)
+    assert "body" not in fp.calls[0][2]
+    assert [json.loads(line) for line in result.stdout.splitlines()] == [
+        {"id": "note-1", "updated": "2023-03-08T15:36:41"},
+        {"id": "note-2", "updated": "2023-03-09T10:00:00"},
+    ]
+    result = CliRunner().invoke(cli, ["--dump", "--fields", "id,colour"])
+    assert result.exit_code == 2
+    assert "--fields must be a comma-separated list of" in result.output
+
+
+@patch("secrets.token_hex")
+def test_max_duration_resumes_with_older_notes(mock_token_hex, fp, tmp_path):
+    mock_token_hex.return_value = "abcdefg"
+    notes_output = FAKE_OUTPUT.replace(
+        b"abcdefg-updated: 2023-03-08T15:36:41\nabcdefg-folder: folder-2",
+        b"abcdefg-updated: 2023-03-09T10:00:00\nabcdefg-folder: folder-2",
+    )
+    note_1_output = notes_output[: notes_output.index(b"abcdefg-id: note-2")]
+    note_2_output = notes_output[notes_output.index(b"abcdefg-id: note-2") :]
+    db_path = str(tmp_path / "notes.db")
+    # A budget so small that it runs out after the first note
+    fp.register_subprocess(["osascript", "-e", FOLDERS_SCRIPT], stdout=FOLDER_OUTPUT)
+    fp.register_subprocess(["osascript", "-e", fp.any()], stdout=METADATA_OUTPUT)
+    fp.register_subprocess(
+        ["osascript", "-e", fp.any()], stdout=note_2_output + b"\n" + note_1_output
+    )
+    result = CliRunner().invoke(cli, [db_path, "--max-duration", "0.000001"])
+    assert_cli_success(result)
+    assert "1 notes left for the next run" in result.output
+    fetch_script = fp.calls[2][2]
+    assert fetch_script.index('"note-2"') < fetch_script.index('"note-1"')
+    db = sqlite_utils.Database(db_path)
+    assert [row["id"] for row in db["notes"].rows] == ["note-2"]
+    assert json.loads(db["sync_state"].get("resume")["value"]) == {
+        "remaining": 1,
+        "next_id": "note-1",
+        "next_updated": "2023-03-08T15:36:41",
+    }
+    assert "last_sync" not in [row["key"] for row in db["sync_state"].rows]
+    assert db["sync_runs"].get(1)["status"] == "partial"
+    # The next run only fetches the note that was not reached
+    fp.register_subprocess(["osascript", "-e", FOLDERS_SCRIPT], stdout=FOLDER_OUTPUT)
+    fp.register_subprocess(["osascript", "-e", fp.any()], stdout=METADATA_OUTPUT)
+    fp.register_subprocess(["osascript", "-e", fp.any()], stdout=note_1_output)
+    result = CliRunner().invoke(cli, [db_path, "--max-duration", "60"])
+    assert_cli_success(result)
+    assert (
+        "Continuing with 1 notes modified at or before 2023-03-08T15:36:41"
+        in result.output
+    )
+    assert '"note-2"' not in fp.calls[-1][2]
+    assert [row["id"] for row in db["notes"].rows] == ["note-2", "note-1"]
+    assert "resume" not in [row["key"] for row in db["sync_state"].rows]
+    assert db["sync_state"].get("last_sync")["value"] == "2023-03-08T15:36:41"
+    assert db["sync_runs"].get(2)["status"] == "completed"
+    # Bodies left pending by --metadata-first count against the budget too
+    with db.conn:
+        db.execute("update notes set body_status = 'pending'")
+    calls = len(fp.calls)
+    fp.register_subprocess(["osascript", "-e", FOLDERS_SCRIPT], stdout=FOLDER_OUTPUT)
+    fp.register_subprocess(["osascript", "-e", fp.any()], stdout=METADATA_OUTPUT)
+    result = CliRunner().invoke(cli, [db_path, "--max-duration", "0.000001"])
+    assert_cli_success(result)
+    assert "2 note bodies left for the next run" in result.output
+    assert len(fp.calls) == calls + 2
+    assert json.loads(db["sync_state"].get("resume")["value"]) == {
+        "remaining": 0,
+        "pending_bodies": 2,
+    }
+    assert db["sync_runs"].get(3)["status"] == "partial"
+    fp.register_subprocess(["osascript", "-e", FOLDERS_SCRIPT], stdout=FOLDER_OUTPUT)
+    fp.register_subprocess(["osascript", "-e", fp.any()], stdout=METADATA_OUTPUT)
+    fp.register_subprocess(["osascript", "-e", fp.any()], stdout=notes_output)
+    result = CliRunner().invoke(cli, [db_path, "--max-duration", "60"])
+    assert_cli_success(result)
+    assert "Continuing with 2 pending note bodies" in result.output
+    assert {row["body_status"] for row in db["notes"].rows} == {"complete"}
+    assert "resume" not in [row["key"] for row in db["sync_state"].rows]
+    assert db["sync_runs"].get(4)["status"] == "completed"
+
+
+def test_notes_index(tmp_path):
+    db_path = str(tmp_path / "notes.db")
+    db = sqlite_utils.Database(db_path)
+    ensure_schema(db)
+    write_folders(
+        db,
+        FolderTree(
+            [
+                {"long_id": "work", "name": "Work", "parent": None},
+                {"long_id": "work-a", "name": "A", "parent": "work"},
+            ]
+        ),
+    )
+    for id, folder, updated, body in (
+        ("n1", 1, "2023-03-01T10:00:00", "Quarterly plan"),
+        ("n2", 2, "2023-03-02T10:00:00", "Plan for A, 100% done"),
+        ("n3", None, "2023-03-03T10:00:00", "Shopping"),
+    ):
+        write_note(
+            db,
+            {
+                "id": id,
+                "title": id.upper(),
+                "updated": updated,
+                "folder": folder,
+                "body": body,
+            },
+        )
+    with NotesIndex(db_path) as index:
+        assert index.get("n2")["body"] == "Plan for A, 100% done"
+        assert index.get("n2")["folder_path"] == "Work/A"
+        assert index.get("missing") is None
+        assert index.cache_info().hits == 1
+        assert [n["id"] for n in index.notes_in_folder("Work")] == ["n1"]
+        assert [n["id"] for n in index.notes_in_folder("Work", subtree=True)] == [
+            "n2",
+            "n1",
+        ]
+        with pytest.raises(KeyError):
+            index.notes_in_folder("Home")
+        assert [n["id"] for n in index.recent(limit=2)] == ["n3", "n2"]
+        assert [n["id"] for n in index.recent(since="2023-03-01T10:00:00")] == [
+            "n3",
+            "n2",
+        ]
+        assert [n["id"] for n in index.search("plan")] == ["n2", "n1"]
+        assert [n["id"] for n in index.search("100%")] == ["n2"]
+        assert "body" not in index.search("plan")[0]
+        # Writes that don't touch notes or folders keep the cache
+        watermark = index.watermark
+        db["sync_state"].insert(
+            {"key": "last_sync", "value": "x"}, pk="key", replace=True
+        )
+        index.get("n2")
+        assert index.cache_info().hits == 2
+        # Rewriting rows with the same values, as every export does for
+        # folders, keeps the cache too
+        write_folders(
+            db,
+            FolderTree(
+                [
+                    {"long_id": "work", "name": "Work", "parent": None},
+                    {"long_id": "work-a", "name": "A", "parent": "work"},
+                ]
+            ),
+        )
+        db["notes"].upsert(dict(db["notes"].get("n1")), pk="id")
+        index.get("n2")
+        assert index.watermark == watermark
+        assert index.cache_info().hits == 3
+        # Changing a note moves the watermark and drops the cache
+        db["notes"].update("n2", {"body": "Changed"})
+        assert index.get("n2")["body"] == "Changed"
+        assert index.watermark != watermark
+        assert index.cache_info().hits == 0
+        db["folders"].update(2, {"path": "Work/B"})
+        assert index.folder_by_path("Work/B")["id"] == 2
+        assert index.folder_by_path("Work/A") is None
+        # Two accounts can each have a folder with the same path
+        db["folders"].insert(
+            {"id": 3, "long_id": "other-work", "name": "Work", "path": "Work"}
+        )
+        db["notes"].update("n3", {"folder": 3})
+        assert [f["id"] for f in index.folders_by_path("Work")] == [1, 3]
+        with pytest.raises(ValueError):
+            index.notes_in_folder("Work")
+        assert [n["id"] for n in index.notes_in_folder("other-work")] == ["n3"]
+        assert [n["id"] for n in index.notes_in_folder(1)] == ["n1"]
+
+
+@patch("secrets.token_hex")
+def test_exports_keep_merged_notes(mock_token_hex, fp, tmp_path):
+    mock_token_hex.return_value = "abcdefg"
+    fp.register_subprocess(["osascript", "-e", COUNT_SCRIPT], stdout=b"2")
+    fp.register_subprocess(["osascript", "-e", FOLDERS_SCRIPT], stdout=FOLDER_OUTPUT)
+    fp.register_subprocess(["osascript", "-e", fp.any()], stdout=FAKE_OUTPUT)
+    db_path = str(tmp_path / "notes.db")
+    assert_cli_success(CliRunner().invoke(cli, [db_path]))
+    db = sqlite_utils.Database(db_path)
+    db["notes"].insert(
+        dict(EXPECTED_NOTES[0], id="merged", source="/backup/NoteStore.sqlite")
+    )
+    # note-1 has been deleted from Notes
+    note_2_output = FAKE_OUTPUT[FAKE_OUTPUT.index(b"abcdefg-id: note-2") :]
+    fp.register_subprocess(["osascript", "-e", FOLDERS_SCRIPT], stdout=FOLDER_OUTPUT)
+    fp.register_subprocess(["osascript", "-e", COUNT_SCRIPT], stdout=b"1")
+    fp.register_subprocess(["osascript", "-e", fp.any()], stdout=note_2_output)
+    result = CliRunner().invoke(cli, [db_path, "--sync-delete-missing"])
+    assert_cli_success(result)
+    assert [row["id"] for row in db["notes"].rows] == ["note-2", "merged"]
+    fp.register_subprocess(["osascript", "-e", FOLDERS_SCRIPT], stdout=FOLDER_OUTPUT)
+    fp.register_subprocess(
+        ["osascript", "-e", fp.any()],
+        stdout=b"\n".join(
+            line
+            for line in note_2_output.splitlines()
+            if line.startswith(b"abcdefg") or not line
+        ),
+    )
+    result = CliRunner().invoke(cli, [db_path, "--verify"])
+    assert_cli_success(result)
+    assert "0 changed, 0 missing, 0 deleted from Notes" in result.output
+    assert [row["id"] for row in db["notes"].rows] == ["note-2", "merged"]